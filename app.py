@@ -1,13 +1,43 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import numba
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google import genai as genai_sdk
+from google.genai import types as genai_types
+from google.genai import errors as genai_errors
+import asyncio
+import csv
+import io
+import itertools
+import json
 import math
+import re
+import threading
 import time
+import uuid
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from contextlib import contextmanager
 from datetime import datetime
 import altair as alt
 
+# Semantic cache (opsional): aktif hanya jika redisvl terpasang dan REDIS_URL diisi di secrets
+try:
+    from redisvl.extensions.cache.llm import SemanticCache
+    from redisvl.utils.vectorize import HFTextVectorizer
+except ImportError:
+    SemanticCache = None
+
+# Parser CSV pyarrow (multithread) dan string Arrow dipakai jika pyarrow terpasang; jika tidak, kembali ke engine C pandas
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE, KEYWORD_DTYPE = 'pyarrow', 'string[pyarrow]'
+except ImportError:
+    CSV_ENGINE, KEYWORD_DTYPE = 'c', 'string'
+
 # --- KONFIGURASI DAN KONEKSI ---
 try:
     genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
@@ -15,19 +45,57 @@ except (KeyError, AttributeError):
     st.error("Kunci API Gemini belum diatur. Harap tambahkan ke secrets Anda.")
     st.stop()
 
+# Pool dipakai bersama semua sesi; penyimpanan paralel dari batch Gemini dibatasi agar tidak menghabiskan pool
+DB_POOL_MAXCONN = 10
+MAX_CONCURRENT_SAVES = 4
+
+@st.cache_resource
+def get_db_pool():
+    return psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_MAXCONN, **st.secrets["postgres"])
+
+@st.cache_resource
+def get_db_save_slots():
+    return threading.BoundedSemaphore(MAX_CONCURRENT_SAVES)
+
+@contextmanager
 def get_db_conn():
+    # Pinjam koneksi dari pool bersama (lintas sesi) dan kembalikan setelah selesai
     try:
-        conn = psycopg2.connect(**st.secrets["postgres"])
-        return conn
+        pool = get_db_pool()
+        conn = pool.getconn()
     except (KeyError, AttributeError):
         st.error("Konfigurasi database PostgreSQL belum diatur. Harap tambahkan ke secrets Anda.")
-        return None
+        yield None
+        return
     except psycopg2.OperationalError as e:
         st.error(f"Gagal terhubung ke database PostgreSQL: {e}")
-        return None
+        yield None
+        return
+    except psycopg2.pool.PoolError as e:
+        # getconn tidak menunggu: langsung gagal jika semua koneksi di pool sedang dipinjam
+        st.error(f"Semua koneksi database sedang dipakai, coba lagi sebentar lagi: {e}")
+        yield None
+        return
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed: conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
 
 # --- FUNGSI-FUNGSI UTAMA ---
+# Naikkan jika struktur tabel seo_keyword_intents berubah; ikut menjadi key cache di bawah
+SCHEMA_VERSION = 1
+
+@st.cache_resource
+def get_db_init_state(schema_version):
+    # Bertahan lintas rerun dan sesi (per proses), tidak seperti variabel modul biasa
+    return {'initialized': False}
+
 def init_db(conn):
+    db_init_state = get_db_init_state(SCHEMA_VERSION)
+    if db_init_state['initialized']: return
     with conn.cursor() as cur:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS seo_keyword_intents (
@@ -37,75 +105,507 @@ def init_db(conn):
             );
         """)
     conn.commit()
+    db_init_state['initialized'] = True
 
-def fetch_existing_intents(conn):
-    try:
-        df_intents = pd.read_sql_query("SELECT top_query, keyword_intent FROM seo_keyword_intents;", conn)
-        df_intents['top_query'] = df_intents['top_query'].str.lower()
-        return df_intents
-    except (Exception, psycopg2.Error) as e:
-        st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
-        return pd.DataFrame(columns=['top_query', 'keyword_intent'])
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_existing_intents(_conn, schema_version=SCHEMA_VERSION):
+    # Normalisasi keyword (sama dengan normalize_keywords) dikerjakan Postgres; hasil di-cache dan dibersihkan setiap kali save_to_db menulis.
+    # Baris cursor langsung dijadikan dict {keyword: intent}, tanpa DataFrame perantara
+    # Error sengaja tidak ditangkap di sini: exception tidak ikut di-cache, sedangkan return {} akan tersimpan selama TTL
+    # Spasi/tab/newline dirapatkan dulu lalu spasi di ujung dibuang (TRIM hanya membuang spasi, .str.strip() semua whitespace).
+    # Baris lama dengan kunci mentah bisa jatuh ke kunci yang sama: urut dari yang terlama agar dict menyimpan intent terbaru
+    with _conn.cursor() as cur:
+        cur.execute(
+            "SELECT LOWER(REGEXP_REPLACE(REGEXP_REPLACE(top_query, '\\s+', ' ', 'g'), '^ | $', '', 'g')), keyword_intent "
+            "FROM seo_keyword_intents ORDER BY tanggal_data_diupdate NULLS FIRST;"
+        )
+        return dict(cur.fetchall())
+
+# Di bawah jumlah baris ini satu INSERT multi-VALUES lebih murah daripada setup COPY + tabel sementara
+COPY_MIN_ROWS = 1024
 
 def save_to_db(conn, df_to_save):
     df_filtered = df_to_save.dropna(subset=['keyword_intent'])
-    df_filtered = df_filtered[df_filtered['keyword_intent'] != 'Unknown'][['Top queries', 'keyword_intent']].copy()
+    df_filtered = df_filtered[df_filtered['keyword_intent'] != 'Unknown'][['Top queries', 'keyword_intent']]
+    # Satu statement upsert tidak boleh menyentuh key yang sama dua kali
+    df_filtered = df_filtered.drop_duplicates(subset=['Top queries'], keep='last')
     if df_filtered.empty: return 0
     now = datetime.now()
-    sql_insert = """
-    INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate)
-    VALUES (%s, %s, %s)
+    # Baris yang intent-nya tidak berubah dilewati: tidak ada versi baris baru maupun tanggal update yang bergeser
+    sql_on_conflict = """
     ON CONFLICT (top_query) DO UPDATE SET
         keyword_intent = EXCLUDED.keyword_intent,
-        tanggal_data_diupdate = EXCLUDED.tanggal_data_diupdate;
+        tanggal_data_diupdate = EXCLUDED.tanggal_data_diupdate
+    WHERE seo_keyword_intents.keyword_intent IS DISTINCT FROM EXCLUDED.keyword_intent;
     """
-    data_to_insert = [(row['Top queries'], row['keyword_intent'], now) for _, row in df_filtered.iterrows()]
+    sql_insert_values = "INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate) VALUES %s" + sql_on_conflict
+    sql_insert_from_tmp = (
+        "INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate) "
+        "SELECT top_query, keyword_intent, tanggal_data_diupdate FROM tmp_intents" + sql_on_conflict
+    )
+    # Ambil kolom sebagai list Python (tanpa iterrows / Series per baris); dipakai oleh kedua jalur
+    queries = df_filtered['Top queries'].to_numpy().tolist()
+    intents = df_filtered['keyword_intent'].to_numpy().tolist()
+    data_to_insert = list(zip(queries, intents, itertools.repeat(now, len(queries))))
     with conn.cursor() as cur:
-        psycopg2.extras.execute_batch(cur, sql_insert, data_to_insert)
+        if len(data_to_insert) < COPY_MIN_ROWS:
+            # Jalur ini selalu < page_size baris, jadi hanya satu statement dan rowcount mencakup semuanya
+            psycopg2.extras.execute_values(cur, sql_insert_values, data_to_insert, template="(%s, %s, %s)", page_size=COPY_MIN_ROWS)
+            rows_written = cur.rowcount
+        else:
+            # Tulis tuple yang sama ke buffer CSV lalu kirim sekali jalan via COPY ke tabel sementara
+            buf = io.StringIO()
+            csv.writer(buf).writerows(data_to_insert)
+            buf.seek(0)
+            cur.execute("CREATE TEMP TABLE tmp_intents (LIKE seo_keyword_intents INCLUDING DEFAULTS) ON COMMIT DROP;")
+            cur.copy_expert("COPY tmp_intents (top_query, keyword_intent, tanggal_data_diupdate) FROM STDIN WITH CSV", buf)
+            cur.execute(sql_insert_from_tmp)
+            rows_written = cur.rowcount
     conn.commit()
-    return len(data_to_insert)
-
-def detect_intents_batch(keywords):
-    prompt = (
-        "Untuk setiap keyword di bawah ini, klasifikasikan intent-nya. "
-        "Anda HARUS memilih HANYA SATU dari empat opsi berikut: Informasional, Komersial, Navigasional, Transaksional.\n\n"
-        "Berikan jawaban HANYA dalam format ini: - keyword: intent\n\n"
-        "Contoh:\n"
-        "- cara membuat kue: Informasional\n- review hp terbaik 2024: Komersial\n"
-        "- login facebook: Navigasional\n- harga tiket pesawat jakarta bali: Transaksional\n\n"
-        "Berikut adalah keyword yang harus dianalisis:\n"
-    )
-    prompt += "\n".join([f"- {kw}" for kw in keywords])
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    response = model.generate_content(prompt)
-    raw = response.text.strip()
-    intents = {
-        parts[0].replace("-", "").strip().lower(): parts[1].strip().capitalize()
-        for line in raw.splitlines() if ":" in line and (parts := line.split(":", 1))
+    fetch_existing_intents.clear()
+    # Hanya baris yang benar-benar ditulis (insert baru atau intent berubah); baris yang dilewati klausa WHERE tidak dihitung
+    return rows_written
+
+def save_intents(intents):
+    """Simpan dict {keyword: intent} dengan koneksi pinjaman sendiri; aman dipanggil dari thread executor.
+
+    Tidak memanggil st.* (output dari thread executor tidak tampil): error dilempar ke pemanggil
+    agar bisa dilaporkan dari thread utama.
+    """
+    pool = get_db_pool()
+    with get_db_save_slots():
+        conn = pool.getconn()
+        try:
+            return save_to_db(conn, pd.DataFrame(list(intents.items()), columns=['Top queries', 'keyword_intent']))
+        except Exception:
+            if not conn.closed: conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+def parse_ctr(series):
+    # Satu pass numpy: buang '%' lalu bagi 100 hanya untuk sel yang ditulis dalam persen.
+    # Mengembalikan (nilai, is_percent) agar pemanggil tidak perlu scan max() lagi untuk kolom persen
+    if pd.api.types.is_numeric_dtype(series): return pd.to_numeric(series, errors='coerce'), False
+    arr = np.char.strip(series.to_numpy().astype(str))
+    has_pct = np.char.endswith(arr, '%')
+    vals = pd.to_numeric(np.char.rstrip(arr, '%'), errors='coerce')
+    return np.where(has_pct, vals / 100.0, vals), bool(has_pct.any())
+
+# Kategori intent yang valid; disimpan sebagai dtype category (kode integer, bukan objek str per baris)
+INTENT_OPTIONS = ["Informasional", "Komersial", "Navigasional", "Transaksional", "Unknown"]
+
+def as_intent_category(series):
+    # Label di luar INTENT_OPTIONS di-mask dulu: astype category pada label asing sudah deprecated di pandas 3
+    return series.where(series.isin(INTENT_OPTIONS)).astype(pd.CategoricalDtype(INTENT_OPTIONS)).fillna('Unknown')
+
+# Di atas jumlah baris ini kernel Numba (paralel, tanpa array sementara) dipakai
+NUMBA_MIN_ROWS = 100_000
+# Ambang CTR; dikonversi ke dtype kolom CTR sebelum dipakai agar jalur numpy dan Numba membandingkan di presisi yang sama
+# (literal float di Numba akan mempromosikan float32 ke float64, numpy tidak)
+CTR_DROP_RATIO = 0.9
+LOW_CTR = 0.02
+
+# Tanpa fastmath: perbandingan (termasuk NaN) harus identik dengan numpy
+@numba.njit(parallel=True, cache=True)
+def _needs_opt_kernel(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr, out):
+    for i in numba.prange(ctr_l.shape[0]):
+        a = ctr_l[i]
+        b = ctr_p[i]
+        out[i] = (a < b * drop_ratio) or ((a < low_ctr) and (pos_l[i] < 3) and (imp_l[i] > 5000)) or ((clk_l[i] < clk_p[i]) and (imp_l[i] > imp_p[i]))
+
+def _needs_opt_numpy(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr):
+    return (ctr_l < ctr_p * drop_ratio) | ((ctr_l < low_ctr) & (pos_l < 3) & (imp_l > 5000)) | ((clk_l < clk_p) & (imp_l > imp_p))
+
+def _needs_opt_numba(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr):
+    out = np.empty(ctr_l.shape[0], dtype=np.bool_)
+    _needs_opt_kernel(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr, out)
+    return out
+
+@st.cache_resource(show_spinner=False)
+def numba_agrees_with_numpy(ctr_dtype, pos_dtype, imp_dtype, clk_dtype):
+    """Cek sekali per kombinasi dtype: kernel Numba harus memberi hasil sama persis dengan numpy pada baris batas ambang."""
+    ctr_l = np.array([0.02, 0.0199, 0.45, 0.449, 0.02, np.nan, 0.0], dtype=ctr_dtype)
+    ctr_p = np.array([0.02, 0.02, 0.5, 0.5, np.nan, 0.5, 0.0], dtype=ctr_dtype)
+    pos_l = np.array([2, 2.999, 2, 2, 2, 3, 1], dtype=pos_dtype)
+    imp_l = np.array([5001, 5001, 10, 10, 5001, 6000, 5000], dtype=imp_dtype)
+    imp_p = np.array([0, 0, 10, 10, 0, 5000, 4999], dtype=imp_dtype)
+    clk_l = np.array([0, 0, 5, 5, 0, 1, 1], dtype=clk_dtype)
+    clk_p = np.array([0, 0, 5, 5, 0, 2, 2], dtype=clk_dtype)
+    thresholds = (ctr_l.dtype.type(CTR_DROP_RATIO), ctr_l.dtype.type(LOW_CTR))
+    args = (ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p) + thresholds
+    return bool(np.array_equal(_needs_opt_numba(*args), _needs_opt_numpy(*args)))
+
+def compute_needs_optimization(df):
+    # Ekspresi boolean langsung di atas array numpy, tanpa Series perantara
+    ctr_l, ctr_p = df['Last 3 months CTR'].to_numpy(), df['Previous 3 months CTR'].to_numpy()
+    imp_l, imp_p = df['Last 3 months Impressions'].to_numpy(), df['Previous 3 months Impressions'].to_numpy()
+    clk_l, clk_p = df['Last 3 months Clicks'].to_numpy(), df['Previous 3 months Clicks'].to_numpy()
+    pos_l = df['Last 3 months Position'].to_numpy()
+    args = (ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, ctr_l.dtype.type(CTR_DROP_RATIO), ctr_l.dtype.type(LOW_CTR))
+    # Jalur Numba hanya dipakai bila terbukti sama dengan jalur numpy untuk dtype ini; hasil tidak boleh bergantung pada jumlah baris
+    if len(df) >= NUMBA_MIN_ROWS and numba_agrees_with_numpy(ctr_l.dtype.str, pos_l.dtype.str, imp_l.dtype.str, clk_l.dtype.str):
+        return _needs_opt_numba(*args)
+    return _needs_opt_numpy(*args)
+
+# Header standar internal sesuai urutan GSC
+STANDARD_HEADERS = [
+    'Top queries', 'Last 3 months Clicks', 'Previous 3 months Clicks',
+    'Last 3 months Impressions', 'Previous 3 months Impressions',
+    'Last 3 months CTR', 'Previous 3 months CTR',
+    'Last 3 months Position', 'Previous 3 months Position'
+]
+# Presisi 32-bit cukup untuk metrik GSC (klik/impresi < 2^31, CTR 0..1, posisi 1..100).
+# Diterapkan setelah fillna, bukan saat read_csv: satu sel kosong/non-angka tidak boleh menggagalkan seluruh upload
+METRIC_DTYPES = {
+    'Last 3 months Clicks': 'int32', 'Previous 3 months Clicks': 'int32',
+    'Last 3 months Impressions': 'int32', 'Previous 3 months Impressions': 'int32',
+    'Last 3 months CTR': 'float32', 'Previous 3 months CTR': 'float32',
+    'Last 3 months Position': 'float32', 'Previous 3 months Position': 'float32'
+}
+
+@st.cache_data(show_spinner=False)
+def load_and_prepare(file_bytes):
+    """Parse CSV GSC dan hitung metrik; di-cache berdasarkan isi file."""
+    # 1. Ambil header asli langsung dari baris pertama, tanpa parse pandas terpisah
+    header_line = file_bytes.split(b'\n', 1)[0].decode('utf-8-sig').rstrip('\r')
+    original_headers = next(csv.reader([header_line]))
+    if len(original_headers) < len(STANDARD_HEADERS):
+        raise ValueError(f"File CSV Anda memiliki {len(original_headers)} kolom, tetapi aplikasi mengharapkan minimal {len(STANDARD_HEADERS)} kolom perbandingan.")
+    standard_headers_to_use = STANDARD_HEADERS[:len(original_headers)]
+
+    # 2. Satu-satunya parse data: MELEWATI header asli dan langsung terapkan header standar.
+    #    Engine pyarrow: kolom angka yang bersih langsung bertipe numerik, CTR dibiarkan string untuk parse_ctr
+    df = pd.read_csv(io.BytesIO(file_bytes), skiprows=1, names=standard_headers_to_use, engine=CSV_ENGINE)
+    column_mapping = dict(zip(original_headers, standard_headers_to_use))
+
+    # 3. Pembersihan data dan penandaan keyword yang perlu dioptimasi
+    metric_cols = [h for h in STANDARD_HEADERS if h != 'Top queries']
+    for col in ('Last 3 months CTR', 'Previous 3 months CTR'):
+        df[col], is_percent = parse_ctr(df[col])
+        if not is_percent and df[col].max() > 1: df[col] /= 100
+    # Kolom yang tidak terbaca numerik (ada sel teks) di-coerce; sel kosong/invalid menjadi 0, baru kemudian di-downcast
+    non_numeric_cols = [col for col in metric_cols if not pd.api.types.is_numeric_dtype(df[col])]
+    if non_numeric_cols: df[non_numeric_cols] = df[non_numeric_cols].apply(pd.to_numeric, errors='coerce')
+    df[metric_cols] = df[metric_cols].fillna(0).astype(METRIC_DTYPES)
+    df['Needs Optimization'] = compute_needs_optimization(df)
+    # Keyword disimpan sebagai string Arrow: buffer kontigu, bukan objek str Python per baris
+    df['Top queries'] = df['Top queries'].astype(KEYWORD_DTYPE)
+    return df, column_mapping
+
+def mark_df_changed():
+    # Versi unik (lintas sesi) untuk df di session_state; wajib dipanggil setiap kali df diganti atau diubah
+    st.session_state.df_version = uuid.uuid4().hex
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def to_csv_bytes(_df, df_version, view_key):
+    # Cache dikunci versi df + state filter, bukan hash isi DataFrame: hash Streamlit untuk frame besar
+    # hanya memakai sampel baris, sehingga edit intent di luar sampel tidak akan terdeteksi
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, encoding='utf-8')
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_intent_chart_spec(intent_agg, period_labels):
+    # Spesifikasi Vega-Lite di-cache per hasil agregasi: rerun tanpa perubahan data tidak membangun ulang chart Altair
+    viz_long = intent_agg.stack().rename_axis(['keyword_intent', 'metric']).reset_index(name='Jumlah')
+    viz_long['Kind'] = viz_long['metric'].str.extract(r'(?:Last|Previous) 3 months (Impressions|Clicks)', expand=False).map({'Impressions': 'Total Impresi', 'Clicks': 'Total Klik'})
+    viz_long['Periode'] = viz_long['metric'].map(period_labels).fillna(viz_long['metric'])
+    return alt.Chart(viz_long).mark_bar().encode(x=alt.X('keyword_intent:N', title='Intent', sort='-y', axis=alt.Axis(labelAngle=-45)), y=alt.Y('Jumlah:Q', title='Jumlah'), color=alt.Color('Periode:N', title='Periode'), xOffset='Periode:N', row=alt.Row('Kind:N', title=None)).resolve_scale(y='independent', color='independent').properties(title="Perbandingan Total per Intent").to_dict()
+
+def normalize_keywords(series):
+    # Lowercase, trim, dan rapatkan spasi ganda: varian penulisan keyword yang sama jadi satu kunci
+    return series.str.lower().str.strip().str.replace(r'\s+', ' ', regex=True)
+
+# Instruksi statis dikirim sebagai system instruction, sehingga tiap request hanya membawa daftar keyword
+INTENT_SYSTEM_INSTRUCTION = (
+    "Untuk setiap keyword yang diberikan, klasifikasikan intent-nya. "
+    "Anda HARUS memilih HANYA SATU dari empat opsi berikut: Informasional, Komersial, Navigasional, Transaksional.\n\n"
+    "Contoh:\n"
+    "- cara membuat kue: Informasional\n- review hp terbaik 2024: Komersial\n"
+    "- login facebook: Navigasional\n- harga tiket pesawat jakarta bali: Transaksional"
+)
+
+def build_intent_prompt(keywords):
+    return "\n".join([f"- {kw}" for kw in keywords])
+
+# Jawaban dipaksa mengikuti schema JSON: daftar {keyword, intent} dengan intent terbatas pada empat opsi
+GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "keyword": {"type": "STRING"},
+                "intent": {"type": "STRING", "enum": ["Informasional", "Komersial", "Navigasional", "Transaksional"]}
+            },
+            "required": ["keyword", "intent"]
+        }
     }
-    return intents
+}
 
-def detect_all_intents_batched(keywords, batch_size=100, delay=5):
-    total = len(keywords)
-    all_intents = {}
-    progress_bar = st.progress(0, text="Memulai proses batch...")
-    total_batches = math.ceil(total / batch_size)
-    for i in range(0, total, batch_size):
-        batch = keywords[i:i+batch_size]
-        current_batch_num = i // batch_size + 1
-        progress_bar.progress(current_batch_num / total_batches, text=f"Memproses batch {current_batch_num} dari {total_batches}...")
+# Hanya empat intent valid yang diterima; kategori lain hasil halusinasi model dibuang dan tidak ikut tersimpan ke database
+_VALID_INTENTS = {opt.lower(): opt for opt in INTENT_OPTIONS if opt != 'Unknown'}
+# Cadangan jika model tetap menjawab dalam format baris "- keyword: intent"
+_INTENT_RE = re.compile(r'^\s*-\s*(.+?)\s*:\s*(Informasional|Komersial|Navigasional|Transaksional)\s*$', re.M | re.I)
+
+def parse_intent_response(raw):
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = None
+    if isinstance(data, list):
+        data = {item.get('keyword'): item.get('intent') for item in data if isinstance(item, dict)}
+    if isinstance(data, dict):
+        return {
+            str(kw).strip().lower(): _VALID_INTENTS[intent.strip().lower()]
+            for kw, intent in data.items()
+            if kw and isinstance(intent, str) and intent.strip().lower() in _VALID_INTENTS
+        }
+    return {kw.lower(): intent.capitalize() for kw, intent in _INTENT_RE.findall(raw)}
+
+async def detect_intents_batch(model, keywords):
+    response = await model.generate_content_async(build_intent_prompt(keywords))
+    return parse_intent_response(response.text.strip())
+
+# Keyword yang tidak ada di jawaban Gemini dikirim ulang (hanya keyword itu saja) dengan backoff eksponensial
+MAX_BATCH_RETRIES = 2
+RETRY_BASE_DELAY = 2
+# Kuota Gemini dihitung per menit: request dimulai paling cepat setiap 60 / GEMINI_RPM detik (15 = free tier gemini-1.5-flash)
+GEMINI_RPM = 15
+# 429 (kuota habis) ditunggu dengan backoff lalu dicoba lagi, bukan menghentikan seluruh run
+MAX_RATE_LIMIT_RETRIES = 4
+RATE_LIMIT_BASE_DELAY = 10
+
+async def detect_all_intents_async(keywords, batch_size, rpm, concurrency, progress_bar, on_batch=None):
+    total_batches = math.ceil(len(keywords) / batch_size)
+    sem = asyncio.Semaphore(concurrency)
+    # Rate limit berbasis jarak waktu mulai antar-request (maks. `rpm` request per menit, termasuk retry),
+    # bukan sleep buta setelah request selesai yang ikut menahan slot semaphore
+    interval = 60 / rpm
+    pacing_lock = asyncio.Lock()
+    next_start = 0.0
+    # Satu model untuk semua batch dalam run ini. Sengaja tidak di-cache_resource lintas rerun:
+    # klien async-nya terikat ke event loop milik asyncio.run yang dibuat ulang setiap rerun
+    model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=INTENT_SYSTEM_INSTRUCTION, generation_config=GEMINI_GENERATION_CONFIG)
+
+    async def request_intents(batch):
+        nonlocal next_start
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            async with sem:
+                async with pacing_lock:
+                    loop_now = loop.time()
+                    if next_start > loop_now: await asyncio.sleep(next_start - loop_now)
+                    next_start = max(next_start, loop_now) + interval
+                try: return await detect_intents_batch(model, batch)
+                except google_exceptions.ResourceExhausted:
+                    if attempt == MAX_RATE_LIMIT_RETRIES: raise
+            # 429: semua request berikutnya ikut mundur (lewat next_start), bukan hanya batch ini
+            next_start = max(next_start, loop.time() + RATE_LIMIT_BASE_DELAY * 2 ** attempt)
+
+    async def run_batch(batch_num, batch):
+        result = {}
+        pending = batch
         try:
-            result = detect_intents_batch(batch)
-            all_intents.update(result)
-            if i + batch_size < total:
-                time.sleep(delay)
-        except Exception as e:
-            st.error(f"Terjadi error pada batch ke-{current_batch_num}: {e}")
+            for attempt in range(MAX_BATCH_RETRIES + 1):
+                # Backoff di luar semaphore agar slot bisa dipakai batch lain selama menunggu
+                if attempt: await asyncio.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                try:
+                    result.update(await request_intents(pending))
+                except Exception as e:
+                    return batch_num, result, e
+                pending = [kw for kw in pending if kw not in result]
+                if not pending: break
+        # Dibatalkan karena batch lain error: hasil parsial (mis. dari percobaan sebelum retry) tetap dikembalikan
+        except asyncio.CancelledError: pass
+        return batch_num, result, None
+
+    tasks = [asyncio.ensure_future(run_batch(n, keywords[i:i+batch_size])) for n, i in enumerate(range(0, len(keywords), batch_size), start=1)]
+    all_intents = {}
+    done = 0
+    # Hasil tiap batch langsung diteruskan ke on_batch di thread executor, sehingga penulisan DB
+    # berjalan bersamaan dengan request Gemini yang masih menunggu
+    loop = asyncio.get_running_loop()
+    pending_saves = []
+    collected = set()
+
+    def collect(batch_num, result):
+        collected.add(batch_num)
+        all_intents.update(result)
+        if on_batch is not None and result: pending_saves.append(loop.run_in_executor(None, on_batch, result))
+
+    for next_done in asyncio.as_completed(tasks):
+        batch_num, result, error = await next_done
+        collect(batch_num, result)
+        if error is not None:
+            st.error(f"Terjadi error pada batch ke-{batch_num}: {error}")
             st.warning("Proses dihentikan. Data yang berhasil dianalisis sebelum error akan tetap disimpan.")
+            for task in tasks: task.cancel()
+            # Batch yang sudah selesai (atau dapat hasil parsial) tapi belum sempat diambil as_completed ikut disimpan
+            for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(outcome, tuple) and outcome[0] not in collected: collect(outcome[0], outcome[1])
             break
+        done += 1
+        progress_bar.progress(done / total_batches, text=f"Selesai {done} dari {total_batches} batch...")
+    await asyncio.gather(*pending_saves)
+    return all_intents
+
+def detect_all_intents_batched(keywords, batch_size=100, rpm=GEMINI_RPM, concurrency=8, on_batch=None):
+    # Keyword duplikat tidak pernah dikirim dua kali, baik dalam satu batch maupun antar-batch
+    keywords = list(dict.fromkeys(keywords))
+    progress_bar = st.progress(0, text="Memulai proses batch...")
+    all_intents = asyncio.run(detect_all_intents_async(keywords, batch_size, rpm, concurrency, progress_bar, on_batch))
     progress_bar.empty()
     return all_intents
 
+# --- GEMINI BATCH API (ASINKRON) ---
+BATCH_JOB_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+def get_genai_client():
+    return genai_sdk.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
+def submit_intent_batch_job(client, keywords, batch_size=100):
+    # Satu baris JSONL per potongan ~100 keyword, key = indeks potongan
+    lines = [
+        json.dumps({
+            "key": str(chunk_idx),
+            "request": {
+                "system_instruction": {"parts": [{"text": INTENT_SYSTEM_INSTRUCTION}]},
+                "contents": [{"role": "user", "parts": [{"text": build_intent_prompt(keywords[i:i+batch_size])}]}],
+                "generation_config": GEMINI_GENERATION_CONFIG
+            }
+        })
+        for chunk_idx, i in enumerate(range(0, len(keywords), batch_size))
+    ]
+    uploaded = client.files.upload(
+        file=io.BytesIO("\n".join(lines).encode('utf-8')),
+        config=genai_types.UploadFileConfig(display_name="seo-keyword-intents", mime_type="jsonl")
+    )
+    batch_job = client.batches.create(model="gemini-2.5-flash-lite", src=uploaded.name, config={"display_name": "seo-keyword-intents"})
+    return batch_job.name
+
+def read_intent_batch_results(client, batch_job):
+    content = client.files.download(file=batch_job.dest.file_name).decode('utf-8')
+    intents = {}
+    for line in content.splitlines():
+        if not line.strip(): continue
+        # Satu baris rusak hanya menghilangkan potongan itu, bukan seluruh hasil job
+        try: candidates = json.loads(line).get('response', {}).get('candidates', [])
+        except json.JSONDecodeError: continue
+        if not candidates: continue
+        raw = "".join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+        intents.update(parse_intent_response(raw.strip()))
+    return intents
+
+def detect_all_intents_batch_api(keywords, max_wait=300, on_batch=None):
+    """Kirim keyword ke Gemini Batch API dan tunggu hasilnya.
+
+    Nama job disimpan di session_state agar rerun berikutnya melanjutkan job yang sama, dan baru dihapus
+    setelah hasilnya terbaca dan diteruskan ke `on_batch`. Mengembalikan None jika job belum selesai dalam
+    `max_wait` detik atau Gemini sementara tidak bisa dihubungi (job tetap disimpan untuk dicoba lagi).
+    """
+    client = get_genai_client()
+    job_name = st.session_state.get('intent_batch_job')
+    if not job_name:
+        with st.spinner("Mengunggah keyword ke Gemini Batch API..."):
+            job_name = submit_intent_batch_job(client, keywords)
+        st.session_state.intent_batch_job = job_name
+
+    wait, waited = 5, 0
+    try:
+        with st.spinner(f"Menunggu job batch {job_name}..."):
+            batch_job = client.batches.get(name=job_name)
+            while batch_job.state.name not in BATCH_JOB_DONE_STATES and waited < max_wait:
+                time.sleep(wait)
+                waited += wait
+                wait = min(wait * 2, 60)
+                batch_job = client.batches.get(name=job_name)
+
+        if batch_job.state.name not in BATCH_JOB_DONE_STATES:
+            return None
+        if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+            del st.session_state.intent_batch_job
+            st.error(f"Job batch berakhir dengan status {batch_job.state.name}.")
+            return {}
+        intents = read_intent_batch_results(client, batch_job)
+    except genai_errors.ClientError as e:
+        # Job atau file hasilnya sudah tidak ada (dihapus/kedaluwarsa): lupakan job agar klik berikutnya mengirim job baru
+        del st.session_state.intent_batch_job
+        st.error(f"Job batch {job_name} tidak dapat diambil lagi: {e}")
+        return {}
+    except Exception as e:
+        st.error(f"Gagal mengambil job batch {job_name}, klik tombol lagi untuk mencoba: {e}")
+        return None
+
+    if on_batch is not None and intents:
+        on_batch(intents)
+    del st.session_state.intent_batch_job
+    return intents
+
+# --- CACHE HASIL INTENT ---
+@st.cache_resource
+def get_semantic_cache():
+    if SemanticCache is None or not st.secrets.get("REDIS_URL"):
+        return None
+    return SemanticCache(
+        name="seo_keyword_intents",
+        redis_url=st.secrets["REDIS_URL"],
+        distance_threshold=0.1,
+        vectorizer=HFTextVectorizer("redis/langcache-embed-v2")
+    )
+
+def split_cached_intents(keywords):
+    """Pisahkan keyword yang intent-nya sudah diketahui dari yang belum.
+
+    Mengembalikan (db_hits, semantic_hits, missing): exact match di DB, hit semantic cache, dan sisanya.
+    """
+    intent_map = {}
+    try:
+        with get_db_conn() as conn:
+            if conn: intent_map = fetch_existing_intents(conn)
+    except psycopg2.Error as e:
+        st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
+    # Label tidak valid yang pernah tersimpan (mis. hasil halusinasi parser lama) dihitung sebagai miss agar dikirim ulang ke Gemini
+    valid_intents = set(_VALID_INTENTS.values())
+    db_hits = {kw: intent_map[kw] for kw in keywords if intent_map.get(kw) in valid_intents}
+    missing = [kw for kw in keywords if kw not in db_hits]
+    semantic_hits = {}
+
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None and missing:
+        still_missing = []
+        for kw in missing:
+            hits = semantic_cache.check(prompt=kw)
+            if hits and hits[0]['response'] in valid_intents: semantic_hits[kw] = hits[0]['response']
+            else: still_missing.append(kw)
+        missing = still_missing
+    return db_hits, semantic_hits, missing
+
+def detect_intents_with_cache(keywords, use_batch_api, on_batch=None):
+    """Hanya keyword yang belum ada di cache yang dikirim ke Gemini. None berarti job batch belum selesai.
+
+    Jika `on_batch` diberikan, setiap potongan hasil yang belum ada di DB (hit semantic cache dan batch Gemini)
+    diteruskan ke sana begitu tersedia. Hit exact dari DB tidak disimpan ulang.
+    """
+    db_hits, semantic_hits, missing = split_cached_intents(keywords)
+    if on_batch is not None and semantic_hits: on_batch(semantic_hits)
+    cached = {**db_hits, **semantic_hits}
+    pending_batch_job = st.session_state.get('intent_batch_job')
+    if not missing and not pending_batch_job:
+        return cached
+    if use_batch_api or pending_batch_job:
+        new_intents = detect_all_intents_batch_api(missing, on_batch=on_batch)
+    else: new_intents = detect_all_intents_batched(missing, on_batch=on_batch)
+    if new_intents is None:
+        return None
+
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        for kw, intent in new_intents.items(): semantic_cache.store(prompt=kw, response=intent)
+    return {**cached, **new_intents}
+
 # --- ANTARMUKA PENGGUNA (STREAMLIT UI) ---
 st.set_page_config(
     page_title="SEO Optimizer",
@@ -118,75 +618,43 @@ def clear_state_on_upload():
     if 'df' in st.session_state: del st.session_state.df
     if 'column_mapping' in st.session_state: del st.session_state.column_mapping
     if 'reverse_mapping' in st.session_state: del st.session_state.reverse_mapping
+    if 'query_key' in st.session_state: del st.session_state.query_key
+    # Job batch milik file sebelumnya; juga membebaskan sesi dari job yang sudah tidak bisa diambil
+    if 'intent_batch_job' in st.session_state: del st.session_state.intent_batch_job
 
 uploaded_file = st.file_uploader("Upload file CSV", type=["csv"], on_change=clear_state_on_upload)
 
 if uploaded_file is not None:
     if 'df' not in st.session_state:
         with st.spinner("Membaca dan memproses file CSV..."):
-            
-            # ### PERBAIKAN UTAMA ADA DI BLOK INI ###
             try:
-                # 1. Baca hanya baris header asli untuk disimpan
-                original_headers = pd.read_csv(uploaded_file, nrows=0).columns.tolist()
-                # Reset pointer file setelah membaca header
-                uploaded_file.seek(0) 
-
-                # 2. Definisikan header standar internal sesuai urutan GSC
-                standard_headers = [
-                    'Top queries', 'Last 3 months Clicks', 'Previous 3 months Clicks',
-                    'Last 3 months Impressions', 'Previous 3 months Impressions',
-                    'Last 3 months CTR', 'Previous 3 months CTR',
-                    'Last 3 months Position', 'Previous 3 months Position'
-                ]
-                
-                if len(original_headers) < len(standard_headers):
-                    st.error(f"File CSV Anda memiliki {len(original_headers)} kolom, tetapi aplikasi mengharapkan minimal {len(standard_headers)} kolom perbandingan.")
-                    st.stop()
-
-                standard_headers_to_use = standard_headers[:len(original_headers)]
-                
-                # 3. Baca data CSV dengan MELEWATI header asli, dan langsung terapkan header standar
-                df = pd.read_csv(uploaded_file, skiprows=1, names=standard_headers_to_use)
-                
-                # 4. Buat dan simpan mapping antara header asli dan standar
-                column_mapping = dict(zip(original_headers, standard_headers_to_use))
-                st.session_state.column_mapping = column_mapping
-                st.session_state.reverse_mapping = {v: k for k, v in column_mapping.items()}
-
+                df, column_mapping = load_and_prepare(uploaded_file.getvalue())
             except Exception as e:
                 st.error(f"Gagal memproses file CSV. Pastikan formatnya benar. Error: {e}")
                 st.stop()
-            
-            # --- Proses pembersihan data (sama seperti sebelumnya) ---
-            metric_cols = [h for h in standard_headers if h != 'Top queries']
-            for col in metric_cols:
-                if col in df.columns:
-                    if 'CTR' in col: df[col] = df[col].astype(str).str.replace('%', '', regex=False)
-                    df[col] = pd.to_numeric(df[col], errors='coerce')
-            df[metric_cols] = df[metric_cols].fillna(0)
-            if df['Last 3 months CTR'].max() > 1: df['Last 3 months CTR'] /= 100
-            if df['Previous 3 months CTR'].max() > 1: df['Previous 3 months CTR'] /= 100
-            df['Needs Optimization'] = ((df['Last 3 months CTR'] < df['Previous 3 months CTR'] * 0.9) | 
-                                        ((df['Last 3 months CTR'] < 0.02) & (df['Last 3 months Position'] < 3) & (df['Last 3 months Impressions'] > 5000)) | 
-                                        ((df['Last 3 months Clicks'] < df['Previous 3 months Clicks']) & (df['Last 3 months Impressions'] > df['Previous 3 months Impressions'])))
-            
+            st.session_state.column_mapping = column_mapping
+            st.session_state.reverse_mapping = {v: k for k, v in column_mapping.items()}
+
+        # Kunci keyword ternormalisasi dihitung sekali per upload lalu dipakai ulang. Sebagai category,
+        # setiap .map() ke dict intent hanya dievaluasi per keyword unik, bukan per baris
+        query_key = normalize_keywords(df['Top queries']).astype('category')
         with st.spinner("Mencocokkan data dengan database..."):
-            conn = get_db_conn()
-            if conn:
-                df_existing_intents = fetch_existing_intents(conn)
-                if not df_existing_intents.empty:
-                    df['query_lower'] = df['Top queries'].str.lower()
-                    df = pd.merge(df, df_existing_intents, left_on='query_lower', right_on='top_query', how='left')
-                    df.drop(columns=['query_lower', 'top_query'], inplace=True, errors='ignore')
-            if 'keyword_intent' not in df.columns: df['keyword_intent'] = 'Unknown'
-            else: df['keyword_intent'] = df['keyword_intent'].fillna('Unknown')
+            intent_map = {}
+            try:
+                with get_db_conn() as conn:
+                    if conn: intent_map = fetch_existing_intents(conn)
+            except psycopg2.Error as e:
+                st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
+            df['keyword_intent'] = as_intent_category(query_key.map(intent_map))
         
         st.session_state.df = df
+        mark_df_changed()
+        st.session_state.query_key = query_key
         st.rerun()
 
     # --- Sisa kode tidak ada perubahan, karena sudah bergantung pada header standar ---
     df = st.session_state.df
+    query_key = st.session_state.query_key
     keyword_col = "Top queries" 
     reverse_mapping = st.session_state.get('reverse_mapping', {})
     column_mapping = st.session_state.get('column_mapping', {})
@@ -196,46 +664,60 @@ if uploaded_file is not None:
     unknown_intent_count = (df['keyword_intent'] == 'Unknown').sum()
     st.sidebar.write(f"**{unknown_intent_count}** keyword belum memiliki intent (dari keseluruhan data).")
 
-    if st.sidebar.button(f"🤖 Generate & Save Intent", disabled=bool(unknown_intent_count == 0)):
-        df_unknown = df[df['keyword_intent'] == 'Unknown']
-        keywords_to_process = df_unknown[keyword_col].unique().tolist()
-        if not keywords_to_process: st.info("Semua keyword sudah memiliki intent.")
+    use_batch_api = st.sidebar.checkbox("Gunakan Gemini Batch API (asinkron, hemat biaya)", value=False)
+    pending_batch_job = st.session_state.get('intent_batch_job')
+    if pending_batch_job: st.sidebar.info(f"Job batch **{pending_batch_job}** masih berjalan. Klik tombol di bawah untuk melanjutkan.")
+
+    if st.sidebar.button(f"🤖 Generate & Save Intent", disabled=bool(unknown_intent_count == 0 and not pending_batch_job)):
+        # Kunci ternormalisasi sudah ada di state; dedup agar varian kapital/spasi tidak dikirim berulang ke Gemini.
+        # Sel keyword kosong (NA, atau string kosong setelah strip) tidak dikirim
+        keywords_to_process = [kw for kw in query_key[(df['keyword_intent'] == 'Unknown').to_numpy()].dropna().drop_duplicates().tolist() if kw]
+        if not keywords_to_process and not pending_batch_job: st.info("Semua keyword sudah memiliki intent.")
         else:
-            new_intents_dict = detect_all_intents_batched(keywords_to_process, delay=20)
-            if new_intents_dict:
-                with st.spinner("Menyimpan hasil AI langsung ke database..."):
-                    conn = get_db_conn()
-                    if conn:
-                        init_db(conn)
-                        df_to_save = pd.DataFrame(list(new_intents_dict.items()), columns=['Top queries', 'keyword_intent'])
-                        rows_saved = save_to_db(conn, df_to_save)
-                        if rows_saved > 0: st.success(f"{rows_saved} intent baru berhasil disimpan ke database!")
+            # Tabel dipastikan ada di thread utama; setiap potongan hasil AI lalu disimpan begitu batch-nya selesai
+            db_ready = False
+            with get_db_conn() as conn:
+                if conn: init_db(conn); db_ready = True
+            saved_counts, save_errors = [], []
+
+            def save_batch(intents):
+                # Bisa berjalan di thread executor: error dikumpulkan dan ditampilkan dari thread utama
+                try: saved_counts.append(save_intents(intents))
+                except Exception as e: save_errors.append(e)
+
+            new_intents_dict = detect_intents_with_cache(keywords_to_process, use_batch_api, on_batch=save_batch if db_ready else None)
+            if save_errors: st.error(f"{len(save_errors)} potongan hasil AI gagal disimpan ke database: {save_errors[0]}")
+            if new_intents_dict is None:
+                st.info("Job batch belum selesai. Klik tombol lagi nanti untuk melanjutkan.")
+            elif new_intents_dict:
+                rows_saved = sum(saved_counts)
+                if rows_saved > 0: st.success(f"{rows_saved} intent baru berhasil disimpan ke database!")
+                # Isi intent baru via lookup dict; baris tanpa hasil AI mempertahankan intent lamanya
                 df_state = st.session_state.df
-                df_new_intents = pd.DataFrame(list(new_intents_dict.items()), columns=['query_lower_case', 'new_intent'])
-                df_state['query_lower_case'] = df_state[keyword_col].str.lower()
-                df_merged = pd.merge(df_state, df_new_intents, on='query_lower_case', how='left')
-                df_merged['keyword_intent'] = df_merged['new_intent'].combine_first(df_merged['keyword_intent'])
-                df_merged.drop(columns=['query_lower_case', 'new_intent'], inplace=True)
-                st.session_state.df = df_merged
+                new_intents = query_key.map(new_intents_dict)
+                df_state['keyword_intent'] = as_intent_category(new_intents.fillna(df_state['keyword_intent'].astype(object)))
+                mark_df_changed()
                 st.info("Tampilan akan diperbarui..."); time.sleep(2); st.rerun()
             else:
                 st.warning("Tidak ada hasil baru dari AI untuk disimpan atau diperbarui.")
 
     st.sidebar.markdown("---"); st.sidebar.header("Filters")
     only_optimize = st.sidebar.checkbox("Hanya tampilkan yang 'Needs Optimization'", value=False)
-    display_df = df.copy()
-    if only_optimize: display_df = display_df[display_df['Needs Optimization']]
+    # Semua filter digabung ke satu mask boolean, lalu df dipotong sekali saja
+    view_mask = np.ones(len(df), dtype=bool)
+    if only_optimize: view_mask &= df['Needs Optimization'].to_numpy(dtype=bool)
 
     st.subheader("Editor Data Keyword")
     all_intents_list = sorted(df['keyword_intent'].unique().tolist())
     selected_intents = st.multiselect("Filter berdasarkan Intent:", options=all_intents_list, default=all_intents_list)
-    if selected_intents: display_df = display_df[display_df['keyword_intent'].isin(selected_intents)]
-    else: display_df = display_df.head(0)
+    if selected_intents: view_mask &= df['keyword_intent'].isin(selected_intents).to_numpy()
+    else: view_mask[:] = False
+    display_df = df.iloc[view_mask]
     unknown_in_view = (display_df['keyword_intent'] == 'Unknown').sum()
     st.info(f"Anda dapat mengubah **Keyword Intent** di bawah. Tampilan saat ini memiliki **{unknown_in_view}** keyword tanpa intent.")
     
     display_df_renamed = display_df.rename(columns=reverse_mapping)
-    column_config = {"keyword_intent": st.column_config.SelectboxColumn(reverse_mapping.get("keyword_intent", "Keyword Intent"), help="Pilih intent manual", width="medium", options=["Informasional", "Komersial", "Navigasional", "Transaksional", "Unknown"], required=True), original_keyword_col: st.column_config.TextColumn(disabled=True),}
+    column_config = {"keyword_intent": st.column_config.SelectboxColumn(reverse_mapping.get("keyword_intent", "Keyword Intent"), help="Pilih intent manual", width="medium", options=INTENT_OPTIONS, required=True), original_keyword_col: st.column_config.TextColumn(disabled=True),}
     for col_name in display_df_renamed.columns:
         if col_name not in [original_keyword_col, 'keyword_intent']:
             column_config[col_name] = st.column_config.Column(disabled=True)
@@ -244,41 +726,43 @@ if uploaded_file is not None:
 
     if st.button("Simpan Perubahan Manual"):
         edited_df = edited_df_renamed.rename(columns=column_mapping)
-        comparison_df = df.merge(edited_df, on=keyword_col, how="inner", suffixes=('_original', '_edited'))
-        changed_rows = comparison_df[comparison_df['keyword_intent_original'] != comparison_df['keyword_intent_edited']]
-        if changed_rows.empty: st.warning("Tidak ada perubahan yang terdeteksi.")
+        # Diff berbasis index: bandingkan intent hasil edit dengan intent asli per keyword, tanpa merge
+        orig = df.set_index(keyword_col)['keyword_intent']
+        orig = orig[~orig.index.duplicated()]
+        edit = edited_df.set_index(keyword_col)['keyword_intent']
+        changed_mask = edit.astype(object).ne(orig.reindex(edit.index).astype(object))
+        if not changed_mask.any(): st.warning("Tidak ada perubahan yang terdeteksi.")
         else:
-            df_changes = pd.DataFrame({'Top queries': changed_rows[keyword_col], 'keyword_intent': changed_rows['keyword_intent_edited']})
-            conn = get_db_conn()
-            if conn:
-                with st.spinner(f"Menyimpan {len(df_changes)} perubahan ke database..."):
-                    init_db(conn)
-                    rows_affected = save_to_db(conn, df_changes)
-                    df_state = st.session_state.df.set_index(keyword_col)
-                    df_changes.set_index(keyword_col, inplace=True)
-                    df_state.update(df_changes)
-                    st.session_state.df = df_state.reset_index()
-                    st.success(f"{rows_affected} perubahan berhasil disimpan!")
-                    st.rerun()
+            df_changes = edit[changed_mask].rename_axis('Top queries').reset_index()
+            # Simpan dengan kunci ternormalisasi yang sama dengan hasil AI, agar satu keyword tidak punya dua baris di tabel
+            df_changes['Top queries'] = normalize_keywords(df_changes['Top queries'])
+            with get_db_conn() as conn:
+                if conn:
+                    with st.spinner(f"Menyimpan {len(df_changes)} perubahan ke database..."):
+                        init_db(conn)
+                        rows_affected = save_to_db(conn, df_changes)
+                        # Tulis langsung ke baris yang berubah, tanpa set_index/update/reset_index
+                        updates = dict(zip(df_changes['Top queries'], df_changes['keyword_intent']))
+                        df_state = st.session_state.df
+                        m = query_key.isin(updates.keys()).to_numpy()
+                        df_state.loc[m, 'keyword_intent'] = query_key[m].map(updates).to_numpy()
+                        mark_df_changed()
+                        st.success(f"{rows_affected} perubahan berhasil disimpan!")
+                        st.rerun()
 
     st.sidebar.markdown("---")
     display_df_download = display_df.rename(columns=reverse_mapping)
-    st.sidebar.download_button("Download Data Tampilan", display_df_download.to_csv(index=False).encode('utf-8'), "seo_analyzed_data.csv", "text/csv")
+    st.sidebar.download_button("Download Data Tampilan", to_csv_bytes(display_df_download, st.session_state.df_version, (only_optimize, tuple(selected_intents))), "seo_analyzed_data.csv", "text/csv")
     st.markdown("---")
     
     st.subheader("📊 Visualisasi Perubahan Trafik per Intent")
-    df_viz = display_df[display_df['keyword_intent'] != 'Unknown'].copy()
+    df_viz = display_df[display_df['keyword_intent'] != 'Unknown']
 
     if not df_viz.empty:
-        intent_agg = df_viz.groupby('keyword_intent')[[ 'Previous 3 months Impressions', 'Last 3 months Impressions', 'Previous 3 months Clicks', 'Last 3 months Clicks' ]].sum().reset_index()
-        impressions_long = intent_agg.melt(id_vars='keyword_intent', value_vars=['Previous 3 months Impressions', 'Last 3 months Impressions'], var_name='Periode', value_name='Jumlah')
-        clicks_long = intent_agg.melt(id_vars='keyword_intent', value_vars=['Previous 3 months Clicks', 'Last 3 months Clicks'], var_name='Periode', value_name='Jumlah')
-        impressions_long['Periode'] = impressions_long['Periode'].map(reverse_mapping)
-        clicks_long['Periode'] = clicks_long['Periode'].map(reverse_mapping)
-        impressions_chart = alt.Chart(impressions_long).mark_bar().encode(x=alt.X('keyword_intent:N', title='Intent', sort='-y', axis=alt.Axis(labelAngle=-45)), y=alt.Y('Jumlah:Q', title=reverse_mapping.get('Last 3 months Impressions', 'Total Impresi')), color=alt.Color('Periode:N', title='Periode'), xOffset='Periode:N').properties(title=f"Perbandingan Total {reverse_mapping.get('Last 3 months Impressions', 'Impresi').split('(')[0].strip()}")
-        clicks_chart = alt.Chart(clicks_long).mark_bar().encode(x=alt.X('keyword_intent:N', title='Intent', sort='-y', axis=alt.Axis(labelAngle=-45)), y=alt.Y('Jumlah:Q', title=reverse_mapping.get('Last 3 months Clicks', 'Total Klik')), color=alt.Color('Periode:N', title='Periode'), xOffset='Periode:N').properties(title=f"Perbandingan Total {reverse_mapping.get('Last 3 months Clicks', 'Klik').split('(')[0].strip()}")
-        st.altair_chart(impressions_chart, use_container_width=True)
-        st.altair_chart(clicks_chart, use_container_width=True)
+        # Satu groupby kecil per rerun; stack ke bentuk panjang dan spesifikasi chart ber-facet diambil dari cache
+        viz_metric_cols = ['Previous 3 months Impressions', 'Last 3 months Impressions', 'Previous 3 months Clicks', 'Last 3 months Clicks']
+        intent_agg = df_viz.groupby('keyword_intent', sort=False, observed=True)[viz_metric_cols].sum()
+        st.vega_lite_chart(build_intent_chart_spec(intent_agg, reverse_mapping), use_container_width=True)
     else:
         st.info("Tidak ada data untuk ditampilkan dalam visualisasi berdasarkan filter Anda saat ini.")
 else:
@@ -1,26 +1,95 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import numba
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google import genai as genai_sdk
+from google.genai import types as genai_types
+from google.genai import errors as genai_errors
+import asyncio
+import csv
+import io
+import itertools
+import json
 import math
+import re
+import threading
 import time
+import uuid
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from contextlib import contextmanager
 from datetime import datetime
 import altair as alt
 
+# Semantic cache (opsional): aktif hanya jika redisvl terpasang dan REDIS_URL diisi di secrets
+try:
+    from redisvl.extensions.cache.llm import SemanticCache
+    from redisvl.utils.vectorize import HFTextVectorizer
+except ImportError:
+    SemanticCache = None
+
+# Parser CSV pyarrow (multithread) dan string Arrow dipakai jika pyarrow terpasang; jika tidak, kembali ke engine C pandas
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE, KEYWORD_DTYPE = 'pyarrow', 'string[pyarrow]'
+except ImportError:
+    CSV_ENGINE, KEYWORD_DTYPE = 'c', 'string'
+
 # --- KONFIGURASI DAN KONEKSI ---
 genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
 
+# Pool dipakai bersama semua sesi; penyimpanan paralel dari batch Gemini dibatasi agar tidak menghabiskan pool
+DB_POOL_MAXCONN = 10
+MAX_CONCURRENT_SAVES = 4
+
+@st.cache_resource
+def get_db_pool():
+    return psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_MAXCONN, **st.secrets["postgres"])
+
+@st.cache_resource
+def get_db_save_slots():
+    return threading.BoundedSemaphore(MAX_CONCURRENT_SAVES)
+
+@contextmanager
 def get_db_conn():
+    # Pinjam koneksi dari pool bersama (lintas sesi) dan kembalikan setelah selesai
     try:
-        conn = psycopg2.connect(**st.secrets["postgres"])
-        return conn
+        pool = get_db_pool()
+        conn = pool.getconn()
     except psycopg2.OperationalError as e:
         st.error(f"Gagal terhubung ke database PostgreSQL: {e}")
-        return None
+        yield None
+        return
+    except psycopg2.pool.PoolError as e:
+        # getconn tidak menunggu: langsung gagal jika semua koneksi di pool sedang dipinjam
+        st.error(f"Semua koneksi database sedang dipakai, coba lagi sebentar lagi: {e}")
+        yield None
+        return
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
 
 # --- FUNGSI-FUNGSI UTAMA ---
+# Naikkan jika struktur tabel seo_keyword_intents berubah; ikut menjadi key cache di bawah
+SCHEMA_VERSION = 1
+
+@st.cache_resource
+def get_db_init_state(schema_version):
+    # Bertahan lintas rerun dan sesi (per proses), tidak seperti variabel modul biasa
+    return {'initialized': False}
+
 def init_db(conn):
+    db_init_state = get_db_init_state(SCHEMA_VERSION)
+    if db_init_state['initialized']:
+        return
     with conn.cursor() as cur:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS seo_keyword_intents (
@@ -30,79 +99,599 @@ def init_db(conn):
             );
         """)
     conn.commit()
-
-def fetch_existing_intents(conn):
-    try:
-        df_intents = pd.read_sql_query("SELECT top_query, keyword_intent FROM seo_keyword_intents;", conn)
-        df_intents['top_query'] = df_intents['top_query'].str.lower()
-        return df_intents
-    except (Exception, psycopg2.Error) as e:
-        st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
-        return pd.DataFrame(columns=['top_query', 'keyword_intent'])
+    db_init_state['initialized'] = True
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_existing_intents(_conn, schema_version=SCHEMA_VERSION):
+    # Normalisasi keyword (sama dengan normalize_keywords) dikerjakan Postgres; hasil di-cache dan dibersihkan setiap kali save_to_db menulis.
+    # Baris cursor langsung dijadikan dict {keyword: intent}, tanpa DataFrame perantara
+    # Error sengaja tidak ditangkap di sini: exception tidak ikut di-cache, sedangkan return {} akan tersimpan selama TTL
+    # Spasi/tab/newline dirapatkan dulu lalu spasi di ujung dibuang (TRIM hanya membuang spasi, .str.strip() semua whitespace).
+    # Baris lama dengan kunci mentah bisa jatuh ke kunci yang sama: urut dari yang terlama agar dict menyimpan intent terbaru
+    with _conn.cursor() as cur:
+        cur.execute(
+            "SELECT LOWER(REGEXP_REPLACE(REGEXP_REPLACE(top_query, '\\s+', ' ', 'g'), '^ | $', '', 'g')), keyword_intent "
+            "FROM seo_keyword_intents ORDER BY tanggal_data_diupdate NULLS FIRST;"
+        )
+        return dict(cur.fetchall())
+
+# Di bawah jumlah baris ini satu INSERT multi-VALUES lebih murah daripada setup COPY + tabel sementara
+COPY_MIN_ROWS = 1024
 
 def save_to_db(conn, df_to_save):
     df_filtered = df_to_save.dropna(subset=['keyword_intent'])
-    df_filtered = df_filtered[df_filtered['keyword_intent'] != 'Unknown'][['Top queries', 'keyword_intent']].copy()
+    df_filtered = df_filtered[df_filtered['keyword_intent'] != 'Unknown'][['Top queries', 'keyword_intent']]
+    # Satu statement upsert tidak boleh menyentuh key yang sama dua kali
+    df_filtered = df_filtered.drop_duplicates(subset=['Top queries'], keep='last')
     if df_filtered.empty: return 0
     now = datetime.now()
-    sql_insert = """
-    INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate)
-    VALUES (%s, %s, %s)
+    # Baris yang intent-nya tidak berubah dilewati: tidak ada versi baris baru maupun tanggal update yang bergeser
+    sql_on_conflict = """
     ON CONFLICT (top_query) DO UPDATE SET
         keyword_intent = EXCLUDED.keyword_intent,
-        tanggal_data_diupdate = EXCLUDED.tanggal_data_diupdate;
+        tanggal_data_diupdate = EXCLUDED.tanggal_data_diupdate
+    WHERE seo_keyword_intents.keyword_intent IS DISTINCT FROM EXCLUDED.keyword_intent;
     """
-    data_to_insert = [(row['Top queries'], row['keyword_intent'], now) for _, row in df_filtered.iterrows()]
+    sql_insert_values = "INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate) VALUES %s" + sql_on_conflict
+    sql_insert_from_tmp = (
+        "INSERT INTO seo_keyword_intents (top_query, keyword_intent, tanggal_data_diupdate) "
+        "SELECT top_query, keyword_intent, tanggal_data_diupdate FROM tmp_intents" + sql_on_conflict
+    )
+    # Ambil kolom sebagai list Python (tanpa iterrows / Series per baris); dipakai oleh kedua jalur
+    queries = df_filtered['Top queries'].to_numpy().tolist()
+    intents = df_filtered['keyword_intent'].to_numpy().tolist()
+    data_to_insert = list(zip(queries, intents, itertools.repeat(now, len(queries))))
     with conn.cursor() as cur:
-        psycopg2.extras.execute_batch(cur, sql_insert, data_to_insert)
+        if len(data_to_insert) < COPY_MIN_ROWS:
+            # Jalur ini selalu < page_size baris, jadi hanya satu statement dan rowcount mencakup semuanya
+            psycopg2.extras.execute_values(cur, sql_insert_values, data_to_insert, template="(%s, %s, %s)", page_size=COPY_MIN_ROWS)
+            rows_written = cur.rowcount
+        else:
+            # Tulis tuple yang sama ke buffer CSV lalu kirim sekali jalan via COPY ke tabel sementara
+            buf = io.StringIO()
+            csv.writer(buf).writerows(data_to_insert)
+            buf.seek(0)
+            cur.execute("CREATE TEMP TABLE tmp_intents (LIKE seo_keyword_intents INCLUDING DEFAULTS) ON COMMIT DROP;")
+            cur.copy_expert("COPY tmp_intents (top_query, keyword_intent, tanggal_data_diupdate) FROM STDIN WITH CSV", buf)
+            cur.execute(sql_insert_from_tmp)
+            rows_written = cur.rowcount
     conn.commit()
-    return len(data_to_insert)
-
-def detect_intents_batch(keywords):
-    prompt = (
-        "Untuk setiap keyword di bawah ini, klasifikasikan intent-nya. "
-        "Anda HARUS memilih HANYA SATU dari empat opsi berikut: Informasional, Komersial, Navigasional, Transaksional.\n\n"
-        "Berikan jawaban HANYA dalam format ini: - keyword: intent\n\n"
-        "Contoh:\n"
-        "- cara membuat kue: Informasional\n- review hp terbaik 2024: Komersial\n"
-        "- login facebook: Navigasional\n- harga tiket pesawat jakarta bali: Transaksional\n\n"
-        "Berikut adalah keyword yang harus dianalisis:\n"
+    fetch_existing_intents.clear()
+    # Hanya baris yang benar-benar ditulis (insert baru atau intent berubah); baris yang dilewati klausa WHERE tidak dihitung
+    return rows_written
+
+def save_intents(intents):
+    """Simpan dict {keyword: intent} dengan koneksi pinjaman sendiri; aman dipanggil dari thread executor.
+
+    Tidak memanggil st.* (output dari thread executor tidak tampil): error dilempar ke pemanggil
+    agar bisa dilaporkan dari thread utama.
+    """
+    pool = get_db_pool()
+    with get_db_save_slots():
+        conn = pool.getconn()
+        try:
+            return save_to_db(conn, pd.DataFrame(list(intents.items()), columns=['Top queries', 'keyword_intent']))
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+def parse_ctr(series):
+    # Satu pass numpy: buang '%' lalu bagi 100 hanya untuk sel yang ditulis dalam persen.
+    # Mengembalikan (nilai, is_percent) agar pemanggil tidak perlu scan max() lagi untuk kolom persen
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_numeric(series, errors='coerce'), False
+    arr = np.char.strip(series.to_numpy().astype(str))
+    has_pct = np.char.endswith(arr, '%')
+    vals = pd.to_numeric(np.char.rstrip(arr, '%'), errors='coerce')
+    return np.where(has_pct, vals / 100.0, vals), bool(has_pct.any())
+
+# Kategori intent yang valid; disimpan sebagai dtype category (kode integer, bukan objek str per baris)
+INTENT_OPTIONS = ["Informasional", "Komersial", "Navigasional", "Transaksional", "Unknown"]
+
+def as_intent_category(series):
+    # Label di luar INTENT_OPTIONS di-mask dulu: astype category pada label asing sudah deprecated di pandas 3
+    return series.where(series.isin(INTENT_OPTIONS)).astype(pd.CategoricalDtype(INTENT_OPTIONS)).fillna('Unknown')
+
+# Di atas jumlah baris ini kernel Numba (paralel, tanpa array sementara) dipakai
+NUMBA_MIN_ROWS = 100_000
+# Ambang CTR; dikonversi ke dtype kolom CTR sebelum dipakai agar jalur numpy dan Numba membandingkan di presisi yang sama
+# (literal float di Numba akan mempromosikan float32 ke float64, numpy tidak)
+CTR_DROP_RATIO = 0.9
+LOW_CTR = 0.02
+
+# Tanpa fastmath: perbandingan (termasuk NaN) harus identik dengan numpy
+@numba.njit(parallel=True, cache=True)
+def _needs_opt_kernel(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr, out):
+    for i in numba.prange(ctr_l.shape[0]):
+        a = ctr_l[i]
+        b = ctr_p[i]
+        out[i] = (a < b * drop_ratio) or ((a < low_ctr) and (pos_l[i] < 3) and (imp_l[i] > 5000)) or ((clk_l[i] < clk_p[i]) and (imp_l[i] > imp_p[i]))
+
+def _needs_opt_numpy(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr):
+    return (ctr_l < ctr_p * drop_ratio) | ((ctr_l < low_ctr) & (pos_l < 3) & (imp_l > 5000)) | ((clk_l < clk_p) & (imp_l > imp_p))
+
+def _needs_opt_numba(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr):
+    out = np.empty(ctr_l.shape[0], dtype=np.bool_)
+    _needs_opt_kernel(ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, drop_ratio, low_ctr, out)
+    return out
+
+@st.cache_resource(show_spinner=False)
+def numba_agrees_with_numpy(ctr_dtype, pos_dtype, imp_dtype, clk_dtype):
+    """Cek sekali per kombinasi dtype: kernel Numba harus memberi hasil sama persis dengan numpy pada baris batas ambang."""
+    ctr_l = np.array([0.02, 0.0199, 0.45, 0.449, 0.02, np.nan, 0.0], dtype=ctr_dtype)
+    ctr_p = np.array([0.02, 0.02, 0.5, 0.5, np.nan, 0.5, 0.0], dtype=ctr_dtype)
+    pos_l = np.array([2, 2.999, 2, 2, 2, 3, 1], dtype=pos_dtype)
+    imp_l = np.array([5001, 5001, 10, 10, 5001, 6000, 5000], dtype=imp_dtype)
+    imp_p = np.array([0, 0, 10, 10, 0, 5000, 4999], dtype=imp_dtype)
+    clk_l = np.array([0, 0, 5, 5, 0, 1, 1], dtype=clk_dtype)
+    clk_p = np.array([0, 0, 5, 5, 0, 2, 2], dtype=clk_dtype)
+    thresholds = (ctr_l.dtype.type(CTR_DROP_RATIO), ctr_l.dtype.type(LOW_CTR))
+    args = (ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p) + thresholds
+    return bool(np.array_equal(_needs_opt_numba(*args), _needs_opt_numpy(*args)))
+
+def compute_needs_optimization(df):
+    # Ekspresi boolean langsung di atas array numpy, tanpa Series perantara
+    ctr_l, ctr_p = df['Last 3 months CTR'].to_numpy(), df['Previous 3 months CTR'].to_numpy()
+    imp_l, imp_p = df['Last 3 months Impressions'].to_numpy(), df['Previous 3 months Impressions'].to_numpy()
+    clk_l, clk_p = df['Last 3 months Clicks'].to_numpy(), df['Previous 3 months Clicks'].to_numpy()
+    pos_l = df['Last 3 months Position'].to_numpy()
+    args = (ctr_l, ctr_p, pos_l, imp_l, imp_p, clk_l, clk_p, ctr_l.dtype.type(CTR_DROP_RATIO), ctr_l.dtype.type(LOW_CTR))
+    # Jalur Numba hanya dipakai bila terbukti sama dengan jalur numpy untuk dtype ini; hasil tidak boleh bergantung pada jumlah baris
+    if len(df) >= NUMBA_MIN_ROWS and numba_agrees_with_numpy(ctr_l.dtype.str, pos_l.dtype.str, imp_l.dtype.str, clk_l.dtype.str):
+        return _needs_opt_numba(*args)
+    return _needs_opt_numpy(*args)
+
+@st.cache_data(show_spinner=False)
+def load_and_prepare(file_bytes):
+    """Parse CSV GSC dan hitung metrik; di-cache berdasarkan isi file."""
+    # Engine pyarrow: parsing multithread dan kolom angka langsung bertipe numerik
+    df = pd.read_csv(io.BytesIO(file_bytes), engine=CSV_ENGINE)
+    df.columns = df.columns.str.strip()
+
+    # Deteksi kolom keyword
+    keyword_col_candidates = ['Top queries', 'Kueri teratas']
+    keyword_col = next((col for col in df.columns if col in keyword_col_candidates), None)
+    if not keyword_col:
+        raise ValueError("Kolom keyword (Top queries / Kueri teratas) tidak ditemukan.")
+
+    # Deteksi kolom metrik dalam satu pass: tiap header di-lowercase sekali lalu dimasukkan ke bucket kata kuncinya
+    metric_buckets = {"klik": [], "tayangan": [], "ctr": [], "posisi": []}
+    for col in df.columns:
+        col_lower = col.lower()
+        for keyword, bucket in metric_buckets.items():
+            if keyword in col_lower:
+                bucket.append((col_lower, col))
+    clicks_cols, impressions_cols, ctr_cols, position_cols = (
+        [col for _, col in sorted(bucket)] for bucket in metric_buckets.values()
     )
-    prompt += "\n".join([f"- {kw}" for kw in keywords])
+
+    # Validasi kolom minimal harus 2 per metrik
+    if not (len(clicks_cols) == len(impressions_cols) == len(ctr_cols) == len(position_cols) == 2):
+        raise ValueError("Jumlah kolom metrik tidak sesuai (Klik, Tayangan, CTR, Posisi harus masing-masing 2).")
+
+    # Mapping ke format internal standar
+    column_mapping = {
+        clicks_cols[1]: 'Last 3 months Clicks',
+        clicks_cols[0]: 'Previous 3 months Clicks',
+        impressions_cols[1]: 'Last 3 months Impressions',
+        impressions_cols[0]: 'Previous 3 months Impressions',
+        ctr_cols[1]: 'Last 3 months CTR',
+        ctr_cols[0]: 'Previous 3 months CTR',
+        position_cols[1]: 'Last 3 months Position',
+        position_cols[0]: 'Previous 3 months Position',
+        keyword_col: 'Top queries'
+    }
+
+    df.rename(columns=column_mapping, inplace=True)
+
+    # Pastikan kolom metrik numerik
+    metric_cols = [
+        'Last 3 months CTR', 'Previous 3 months CTR',
+        'Last 3 months Position', 'Previous 3 months Position',
+        'Last 3 months Impressions', 'Previous 3 months Impressions',
+        'Last 3 months Clicks', 'Previous 3 months Clicks'
+    ]
+
+    # Snapshot nama kolom sekali saja, bukan lookup berulang ke df.columns
+    cols = frozenset(df.columns)
+    for col in metric_cols:
+        if col not in cols:
+            df[col] = 0
+    # Snapshot dtype setelah kolom yang hilang diisi, agar setiap kolom metrik pasti ada di dalamnya
+    dtypes = df.dtypes.to_dict()
+
+    for col in ('Last 3 months CTR', 'Previous 3 months CTR'):
+        df[col], is_percent = parse_ctr(df[col])
+        # Normalisasi CTR ke bentuk desimal jika perlu; kolom '%' sudah dinormalisasi saat parsing
+        if not is_percent and df[col].max() > 1:
+            df[col] = df[col] / 100
+
+    # Kolom dari engine pyarrow biasanya sudah numerik; hanya yang belum numerik (object atau str) dikonversi, sekaligus
+    object_cols = [col for col in metric_cols if 'CTR' not in col and not pd.api.types.is_numeric_dtype(dtypes[col])]
+    if object_cols:
+        df[object_cols] = df[object_cols].apply(pd.to_numeric, errors='coerce')
+    df[metric_cols] = df[metric_cols].fillna(0)
+
+    # Presisi 32-bit cukup untuk metrik GSC (klik/impresi < 2^31, CTR 0..1, posisi 1..100)
+    float_cols = [col for col in metric_cols if 'CTR' in col or 'Position' in col]
+    int_cols = [col for col in metric_cols if col not in float_cols]
+    df[float_cols] = df[float_cols].astype('float32')
+    df[int_cols] = df[int_cols].astype('int32')
+
+    # Logika: butuh optimasi?
+    df['Needs Optimization'] = compute_needs_optimization(df)
+    # Keyword disimpan sebagai string Arrow: buffer kontigu, bukan objek str Python per baris
+    df['Top queries'] = df['Top queries'].astype(KEYWORD_DTYPE)
+    return df, column_mapping
+
+def mark_df_changed():
+    # Versi unik (lintas sesi) untuk df di session_state; wajib dipanggil setiap kali df diganti atau diubah
+    st.session_state.df_version = uuid.uuid4().hex
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def to_csv_bytes(_df, df_version, view_key):
+    # Cache dikunci versi df + state filter, bukan hash isi DataFrame: hash Streamlit untuk frame besar
+    # hanya memakai sampel baris, sehingga edit intent di luar sampel tidak akan terdeteksi
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, encoding='utf-8')
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_intent_chart_spec(intent_agg, header_labels):
+    """Bangun spesifikasi Vega-Lite chart intent dengan header asli; di-cache per hasil agregasi."""
+    def get_original_header(standard_name):
+        return header_labels.get(standard_name, standard_name)
+
+    # Buat label untuk visualisasi
+    original_labels = {
+        'last_impressions': get_original_header('Last 3 months Impressions'),
+        'prev_impressions': get_original_header('Previous 3 months Impressions'),
+        'last_clicks': get_original_header('Last 3 months Clicks'),
+        'prev_clicks': get_original_header('Previous 3 months Clicks'),
+        'intent': 'Tipe Intent'
+    }
+
+    # Stack langsung ke bentuk panjang (Intent, metric, Total)
+    df_chart = intent_agg.stack().rename_axis(['Intent', 'metric']).reset_index(name='Total')
+    kind = df_chart['metric'].str.extract(r'(?:Last|Previous) 3 months (Impressions|Clicks)', expand=False)
+    df_chart['Metrik'] = kind.map({
+        'Impressions': f"{original_labels['last_impressions']} vs {original_labels['prev_impressions']}",
+        'Clicks': f"{original_labels['last_clicks']} vs {original_labels['prev_clicks']}"
+    })
+    df_chart['Periode'] = df_chart['metric'].map(get_original_header)
+
+    # Satu spesifikasi Altair, facet per metrik (berdampingan)
+    chart = alt.Chart(df_chart).mark_bar().encode(
+        x=alt.X('Intent:N', title=original_labels['intent'], sort='-y'),
+        y=alt.Y('Total:Q', title=''),
+        color=alt.Color('Periode:N', title='Periode',
+                       scale=alt.Scale(range=['#4E79A7', '#F28E2B'])),
+        xOffset='Periode:N',
+        column=alt.Column('Metrik:N', title=None)
+    ).resolve_scale(
+        y='independent',
+        color='independent'
+    )
+    return chart.to_dict()
+
+def normalize_keywords(series):
+    # Lowercase, trim, dan rapatkan spasi ganda: varian penulisan keyword yang sama jadi satu kunci
+    return series.str.lower().str.strip().str.replace(r'\s+', ' ', regex=True)
+
+# Instruksi statis dikirim sebagai system instruction, sehingga tiap request hanya membawa daftar keyword
+INTENT_SYSTEM_INSTRUCTION = (
+    "Untuk setiap keyword yang diberikan, klasifikasikan intent-nya. "
+    "Anda HARUS memilih HANYA SATU dari empat opsi berikut: Informasional, Komersial, Navigasional, Transaksional.\n\n"
+    "Contoh:\n"
+    "- cara membuat kue: Informasional\n- review hp terbaik 2024: Komersial\n"
+    "- login facebook: Navigasional\n- harga tiket pesawat jakarta bali: Transaksional"
+)
+
+def build_intent_prompt(keywords):
+    return "\n".join([f"- {kw}" for kw in keywords])
+
+# Jawaban dipaksa mengikuti schema JSON: daftar {keyword, intent} dengan intent terbatas pada empat opsi
+GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "keyword": {"type": "STRING"},
+                "intent": {"type": "STRING", "enum": ["Informasional", "Komersial", "Navigasional", "Transaksional"]}
+            },
+            "required": ["keyword", "intent"]
+        }
+    }
+}
+
+# Hanya empat intent valid yang diterima; kategori lain hasil halusinasi model dibuang dan tidak ikut tersimpan ke database
+_VALID_INTENTS = {opt.lower(): opt for opt in INTENT_OPTIONS if opt != 'Unknown'}
+# Cadangan jika model tetap menjawab dalam format baris "- keyword: intent"
+_INTENT_RE = re.compile(r'^\s*-\s*(.+?)\s*:\s*(Informasional|Komersial|Navigasional|Transaksional)\s*$', re.M | re.I)
+
+def parse_intent_response(raw):
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
-        raw = response.text.strip()
-        intents = {
-            parts[0].replace("-", "").strip().lower(): parts[1].strip().capitalize()
-            for line in raw.splitlines() if ":" in line and (parts := line.split(":", 1))
+        data = json.loads(raw)
+    except ValueError:
+        data = None
+    if isinstance(data, list):
+        data = {item.get('keyword'): item.get('intent') for item in data if isinstance(item, dict)}
+    if isinstance(data, dict):
+        return {
+            str(kw).strip().lower(): _VALID_INTENTS[intent.strip().lower()]
+            for kw, intent in data.items()
+            if kw and isinstance(intent, str) and intent.strip().lower() in _VALID_INTENTS
         }
-        return intents
+    return {kw.lower(): intent.capitalize() for kw, intent in _INTENT_RE.findall(raw)}
+
+async def detect_intents_batch(model, keywords):
+    try:
+        response = await model.generate_content_async(build_intent_prompt(keywords))
+        return parse_intent_response(response.text.strip())
+    except google_exceptions.ResourceExhausted:
+        # 429 diteruskan agar request_intents bisa menunggu dan mencoba lagi
+        raise
     except Exception as e:
         st.error(f"[Gemini ERROR]: {e}")
         return {}
 
-def detect_all_intents_batched(keywords, batch_size=100, delay=5):
-    total = len(keywords)
-    all_intents = {}
-    progress_bar = st.progress(0, text="Memulai proses batch...")
-    total_batches = math.ceil(total / batch_size)
-    for i in range(0, total, batch_size):
-        batch = keywords[i:i+batch_size]
-        current_batch_num = i // batch_size + 1
-        progress_bar.progress(current_batch_num / total_batches, text=f"Memproses batch {current_batch_num} dari {total_batches}...")
+# Keyword yang tidak ada di jawaban Gemini dikirim ulang (hanya keyword itu saja) dengan backoff eksponensial
+MAX_BATCH_RETRIES = 2
+RETRY_BASE_DELAY = 2
+# Kuota Gemini dihitung per menit: request dimulai paling cepat setiap 60 / GEMINI_RPM detik (15 = free tier gemini-1.5-flash)
+GEMINI_RPM = 15
+# 429 (kuota habis) ditunggu dengan backoff lalu dicoba lagi, bukan menghentikan seluruh run
+MAX_RATE_LIMIT_RETRIES = 4
+RATE_LIMIT_BASE_DELAY = 10
+
+async def detect_all_intents_async(keywords, batch_size, rpm, concurrency, progress_bar, on_batch=None):
+    total_batches = math.ceil(len(keywords) / batch_size)
+    sem = asyncio.Semaphore(concurrency)
+    # Rate limit berbasis jarak waktu mulai antar-request (maks. `rpm` request per menit, termasuk retry),
+    # bukan sleep buta setelah request selesai yang ikut menahan slot semaphore
+    interval = 60 / rpm
+    pacing_lock = asyncio.Lock()
+    next_start = 0.0
+    # Satu model untuk semua batch dalam run ini. Sengaja tidak di-cache_resource lintas rerun:
+    # klien async-nya terikat ke event loop milik asyncio.run yang dibuat ulang setiap rerun
+    model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=INTENT_SYSTEM_INSTRUCTION, generation_config=GEMINI_GENERATION_CONFIG)
+
+    async def request_intents(batch):
+        nonlocal next_start
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            async with sem:
+                async with pacing_lock:
+                    loop_now = loop.time()
+                    if next_start > loop_now:
+                        await asyncio.sleep(next_start - loop_now)
+                    next_start = max(next_start, loop_now) + interval
+                try:
+                    return await detect_intents_batch(model, batch)
+                except google_exceptions.ResourceExhausted:
+                    if attempt == MAX_RATE_LIMIT_RETRIES:
+                        raise
+            # 429: semua request berikutnya ikut mundur (lewat next_start), bukan hanya batch ini
+            next_start = max(next_start, loop.time() + RATE_LIMIT_BASE_DELAY * 2 ** attempt)
+
+    async def run_batch(batch_num, batch):
+        result = {}
+        pending = batch
         try:
-            result = detect_intents_batch(batch)
-            all_intents.update(result)
-            if i + batch_size < total:
-                time.sleep(delay)
-        except Exception as e:
-            st.error(f"Terjadi error pada batch ke-{current_batch_num}: {e}")
+            for attempt in range(MAX_BATCH_RETRIES + 1):
+                if attempt:
+                    # Backoff di luar semaphore agar slot bisa dipakai batch lain selama menunggu
+                    await asyncio.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                try:
+                    result.update(await request_intents(pending))
+                except Exception as e:
+                    return batch_num, result, e
+                pending = [kw for kw in pending if kw not in result]
+                if not pending:
+                    break
+        except asyncio.CancelledError:
+            # Dibatalkan karena batch lain error: hasil parsial (mis. dari percobaan sebelum retry) tetap dikembalikan
+            pass
+        return batch_num, result, None
+
+    tasks = [asyncio.ensure_future(run_batch(n, keywords[i:i+batch_size])) for n, i in enumerate(range(0, len(keywords), batch_size), start=1)]
+    all_intents = {}
+    done = 0
+    # Hasil tiap batch langsung diteruskan ke on_batch di thread executor, sehingga penulisan DB
+    # berjalan bersamaan dengan request Gemini yang masih menunggu
+    loop = asyncio.get_running_loop()
+    pending_saves = []
+    collected = set()
+
+    def collect(batch_num, result):
+        collected.add(batch_num)
+        all_intents.update(result)
+        if on_batch is not None and result:
+            pending_saves.append(loop.run_in_executor(None, on_batch, result))
+
+    for next_done in asyncio.as_completed(tasks):
+        batch_num, result, error = await next_done
+        collect(batch_num, result)
+        if error is not None:
+            st.error(f"Terjadi error pada batch ke-{batch_num}: {error}")
             st.warning("Proses dihentikan. Data yang berhasil dianalisis sebelum error akan tetap disimpan.")
+            for task in tasks:
+                task.cancel()
+            # Batch yang sudah selesai (atau dapat hasil parsial) tapi belum sempat diambil as_completed ikut disimpan
+            for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(outcome, tuple) and outcome[0] not in collected:
+                    collect(outcome[0], outcome[1])
             break
+        done += 1
+        progress_bar.progress(done / total_batches, text=f"Selesai {done} dari {total_batches} batch...")
+    await asyncio.gather(*pending_saves)
+    return all_intents
+
+def detect_all_intents_batched(keywords, batch_size=100, rpm=GEMINI_RPM, concurrency=8, on_batch=None):
+    # Keyword duplikat tidak pernah dikirim dua kali, baik dalam satu batch maupun antar-batch
+    keywords = list(dict.fromkeys(keywords))
+    progress_bar = st.progress(0, text="Memulai proses batch...")
+    all_intents = asyncio.run(detect_all_intents_async(keywords, batch_size, rpm, concurrency, progress_bar, on_batch))
     progress_bar.empty()
     return all_intents
 
+# --- GEMINI BATCH API (ASINKRON) ---
+BATCH_JOB_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+def get_genai_client():
+    return genai_sdk.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
+def submit_intent_batch_job(client, keywords, batch_size=100):
+    # Satu baris JSONL per potongan ~100 keyword, key = indeks potongan
+    lines = [
+        json.dumps({
+            "key": str(chunk_idx),
+            "request": {
+                "system_instruction": {"parts": [{"text": INTENT_SYSTEM_INSTRUCTION}]},
+                "contents": [{"role": "user", "parts": [{"text": build_intent_prompt(keywords[i:i+batch_size])}]}],
+                "generation_config": GEMINI_GENERATION_CONFIG
+            }
+        })
+        for chunk_idx, i in enumerate(range(0, len(keywords), batch_size))
+    ]
+    uploaded = client.files.upload(
+        file=io.BytesIO("\n".join(lines).encode('utf-8')),
+        config=genai_types.UploadFileConfig(display_name="seo-keyword-intents", mime_type="jsonl")
+    )
+    batch_job = client.batches.create(model="gemini-2.5-flash-lite", src=uploaded.name, config={"display_name": "seo-keyword-intents"})
+    return batch_job.name
+
+def read_intent_batch_results(client, batch_job):
+    content = client.files.download(file=batch_job.dest.file_name).decode('utf-8')
+    intents = {}
+    for line in content.splitlines():
+        if not line.strip(): continue
+        # Satu baris rusak hanya menghilangkan potongan itu, bukan seluruh hasil job
+        try: candidates = json.loads(line).get('response', {}).get('candidates', [])
+        except json.JSONDecodeError: continue
+        if not candidates: continue
+        raw = "".join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+        intents.update(parse_intent_response(raw.strip()))
+    return intents
+
+def detect_all_intents_batch_api(keywords, max_wait=300, on_batch=None):
+    """Kirim keyword ke Gemini Batch API dan tunggu hasilnya.
+
+    Nama job disimpan di session_state agar rerun berikutnya melanjutkan job yang sama, dan baru dihapus
+    setelah hasilnya terbaca dan diteruskan ke `on_batch`. Mengembalikan None jika job belum selesai dalam
+    `max_wait` detik atau Gemini sementara tidak bisa dihubungi (job tetap disimpan untuk dicoba lagi).
+    """
+    client = get_genai_client()
+    job_name = st.session_state.get('intent_batch_job')
+    if not job_name:
+        with st.spinner("Mengunggah keyword ke Gemini Batch API..."):
+            job_name = submit_intent_batch_job(client, keywords)
+        st.session_state.intent_batch_job = job_name
+
+    wait, waited = 5, 0
+    try:
+        with st.spinner(f"Menunggu job batch {job_name}..."):
+            batch_job = client.batches.get(name=job_name)
+            while batch_job.state.name not in BATCH_JOB_DONE_STATES and waited < max_wait:
+                time.sleep(wait)
+                waited += wait
+                wait = min(wait * 2, 60)
+                batch_job = client.batches.get(name=job_name)
+
+        if batch_job.state.name not in BATCH_JOB_DONE_STATES:
+            return None
+        if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+            del st.session_state.intent_batch_job
+            st.error(f"Job batch berakhir dengan status {batch_job.state.name}.")
+            return {}
+        intents = read_intent_batch_results(client, batch_job)
+    except genai_errors.ClientError as e:
+        # Job atau file hasilnya sudah tidak ada (dihapus/kedaluwarsa): lupakan job agar klik berikutnya mengirim job baru
+        del st.session_state.intent_batch_job
+        st.error(f"Job batch {job_name} tidak dapat diambil lagi: {e}")
+        return {}
+    except Exception as e:
+        st.error(f"Gagal mengambil job batch {job_name}, klik tombol lagi untuk mencoba: {e}")
+        return None
+
+    if on_batch is not None and intents:
+        on_batch(intents)
+    del st.session_state.intent_batch_job
+    return intents
+
+# --- CACHE HASIL INTENT ---
+@st.cache_resource
+def get_semantic_cache():
+    if SemanticCache is None or not st.secrets.get("REDIS_URL"):
+        return None
+    return SemanticCache(
+        name="seo_keyword_intents",
+        redis_url=st.secrets["REDIS_URL"],
+        distance_threshold=0.1,
+        vectorizer=HFTextVectorizer("redis/langcache-embed-v2")
+    )
+
+def split_cached_intents(keywords):
+    """Pisahkan keyword yang intent-nya sudah diketahui dari yang belum.
+
+    Mengembalikan (db_hits, semantic_hits, missing): exact match di DB, hit semantic cache, dan sisanya.
+    """
+    intent_map = {}
+    try:
+        with get_db_conn() as conn:
+            if conn:
+                intent_map = fetch_existing_intents(conn)
+    except psycopg2.Error as e:
+        st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
+    # Label tidak valid yang pernah tersimpan (mis. hasil halusinasi parser lama) dihitung sebagai miss agar dikirim ulang ke Gemini
+    valid_intents = set(_VALID_INTENTS.values())
+    db_hits = {kw: intent_map[kw] for kw in keywords if intent_map.get(kw) in valid_intents}
+    missing = [kw for kw in keywords if kw not in db_hits]
+    semantic_hits = {}
+
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None and missing:
+        still_missing = []
+        for kw in missing:
+            hits = semantic_cache.check(prompt=kw)
+            if hits and hits[0]['response'] in valid_intents:
+                semantic_hits[kw] = hits[0]['response']
+            else:
+                still_missing.append(kw)
+        missing = still_missing
+    return db_hits, semantic_hits, missing
+
+def detect_intents_with_cache(keywords, use_batch_api, on_batch=None):
+    """Hanya keyword yang belum ada di cache yang dikirim ke Gemini. None berarti job batch belum selesai.
+
+    Jika `on_batch` diberikan, setiap potongan hasil yang belum ada di DB (hit semantic cache dan batch Gemini)
+    diteruskan ke sana begitu tersedia. Hit exact dari DB tidak disimpan ulang.
+    """
+    db_hits, semantic_hits, missing = split_cached_intents(keywords)
+    if on_batch is not None and semantic_hits:
+        on_batch(semantic_hits)
+    cached = {**db_hits, **semantic_hits}
+    pending_batch_job = st.session_state.get('intent_batch_job')
+    if not missing and not pending_batch_job:
+        return cached
+    if use_batch_api or pending_batch_job:
+        new_intents = detect_all_intents_batch_api(missing, on_batch=on_batch)
+    else:
+        new_intents = detect_all_intents_batched(missing, on_batch=on_batch)
+    if new_intents is None:
+        return None
+
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        for kw, intent in new_intents.items():
+            semantic_cache.store(prompt=kw, response=intent)
+    return {**cached, **new_intents}
+
 # --- ANTARMUKA PENGGUNA ---
 st.set_page_config(page_title="SEO Optimizer", layout="wide")
 st.title("SEO Analysis Dashboard")
@@ -110,134 +699,99 @@ st.title("SEO Analysis Dashboard")
 def clear_state_on_upload():
     if 'df' in st.session_state:
         del st.session_state.df
+    if 'query_key' in st.session_state:
+        del st.session_state.query_key
+    # Job batch milik file sebelumnya; juga membebaskan sesi dari job yang sudah tidak bisa diambil
+    if 'intent_batch_job' in st.session_state:
+        del st.session_state.intent_batch_job
 
 uploaded_file = st.file_uploader("Upload file CSV", type=["csv"], on_change=clear_state_on_upload)
 
 if uploaded_file is not None:
     if 'df' not in st.session_state:
         with st.spinner("Membaca dan memproses file CSV..."):
-            df = pd.read_csv(uploaded_file)
-            original_headers = df.columns.tolist()
-            df.columns = df.columns.str.strip()
-
-            # Deteksi kolom keyword
-            keyword_col_candidates = ['Top queries', 'Kueri teratas']
-            keyword_col = next((col for col in df.columns if col in keyword_col_candidates), None)
-            if not keyword_col:
-                st.error("Kolom keyword (Top queries / Kueri teratas) tidak ditemukan."); st.stop()
-
-            # Fungsi untuk mendeteksi kolom berdasarkan kata kunci
-            def detect_metric_columns(columns, keyword):
-                return sorted(
-                    [col for col in columns if keyword.lower() in col.lower()],
-                    key=lambda x: x.lower()
-                )
-
-            clicks_cols = detect_metric_columns(df.columns, "klik")
-            impressions_cols = detect_metric_columns(df.columns, "tayangan")
-            ctr_cols = detect_metric_columns(df.columns, "ctr")
-            position_cols = detect_metric_columns(df.columns, "posisi")
-
-            # Validasi kolom minimal harus 2 per metrik
-            if not (len(clicks_cols) == len(impressions_cols) == len(ctr_cols) == len(position_cols) == 2):
-                st.error("Jumlah kolom metrik tidak sesuai (Klik, Tayangan, CTR, Posisi harus masing-masing 2)."); st.stop()
-
-            # Mapping ke format internal standar
-            column_mapping = {
-                clicks_cols[1]: 'Last 3 months Clicks',
-                clicks_cols[0]: 'Previous 3 months Clicks',
-                impressions_cols[1]: 'Last 3 months Impressions',
-                impressions_cols[0]: 'Previous 3 months Impressions',
-                ctr_cols[1]: 'Last 3 months CTR',
-                ctr_cols[0]: 'Previous 3 months CTR',
-                position_cols[1]: 'Last 3 months Position',
-                position_cols[0]: 'Previous 3 months Position',
-                keyword_col: 'Top queries'
-            }
-            
+            try:
+                df, column_mapping = load_and_prepare(uploaded_file.getvalue())
+            except ValueError as e:
+                st.error(str(e)); st.stop()
+
             # Simpan mapping untuk tampilan
             st.session_state.column_mapping = column_mapping
             st.session_state.reverse_mapping = {v: k for k, v in column_mapping.items()}
             st.session_state.original_headers = {standard: original for original, standard in column_mapping.items()}
-            
-            df.rename(columns=column_mapping, inplace=True)
-
-            # Pastikan kolom metrik numerik
-            metric_cols = [
-                'Last 3 months CTR', 'Previous 3 months CTR',
-                'Last 3 months Position', 'Previous 3 months Position',
-                'Last 3 months Impressions', 'Previous 3 months Impressions',
-                'Last 3 months Clicks', 'Previous 3 months Clicks'
-            ]
-
-            for col in metric_cols:
-                if col not in df.columns:
-                    df[col] = 0
-                if 'CTR' in col:
-                    df[col] = df[col].astype(str).str.replace('%', '', regex=False)
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            df[metric_cols] = df[metric_cols].fillna(0)
-
-            # Normalisasi CTR ke bentuk desimal jika perlu
-            if df['Last 3 months CTR'].max() > 1:
-                df['Last 3 months CTR'] = df['Last 3 months CTR'] / 100
-            if df['Previous 3 months CTR'].max() > 1:
-                df['Previous 3 months CTR'] = df['Previous 3 months CTR'] / 100
-
-            # Logika: butuh optimasi?
-            df['Needs Optimization'] = (
-                (df['Last 3 months CTR'] < df['Previous 3 months CTR'] * 0.9) |
-                ((df['Last 3 months CTR'] < 0.02) & (df['Last 3 months Position'] < 3) & (df['Last 3 months Impressions'] > 5000)) |
-                ((df['Last 3 months Clicks'] < df['Previous 3 months Clicks']) & (df['Last 3 months Impressions'] > df['Previous 3 months Impressions']))
-            )
 
+        # Kunci keyword ternormalisasi dihitung sekali per upload lalu dipakai ulang. Sebagai category,
+        # setiap .map() ke dict intent hanya dievaluasi per keyword unik, bukan per baris
+        query_key = normalize_keywords(df['Top queries']).astype('category')
         with st.spinner("Mencocokkan data dengan database..."):
-            conn = get_db_conn()
-            if conn:
-                df_existing_intents = fetch_existing_intents(conn)
-                if not df_existing_intents.empty:
-                    df['query_lower'] = df['Top queries'].str.lower()
-                    df = pd.merge(df, df_existing_intents, left_on='query_lower', right_on='top_query', how='left')
-                    df.drop(columns=['query_lower', 'top_query'], inplace=True, errors='ignore')
-
-            if 'keyword_intent' not in df.columns:
-                df['keyword_intent'] = 'Unknown'
-            else:
-                df['keyword_intent'].fillna('Unknown', inplace=True)
+            intent_map = {}
+            try:
+                with get_db_conn() as conn:
+                    if conn:
+                        intent_map = fetch_existing_intents(conn)
+            except psycopg2.Error as e:
+                st.warning(f"Tidak dapat mengambil data intent dari database: {e}")
+
+            # Lookup dict per kunci ternormalisasi, tanpa merge dan kolom sementara
+            df['keyword_intent'] = as_intent_category(query_key.map(intent_map))
 
         st.session_state.df = df
+        mark_df_changed()
+        st.session_state.query_key = query_key
         st.rerun()
 
     df = st.session_state.df
+    query_key = st.session_state.query_key
     keyword_col = "Top queries"
 
     st.sidebar.header("Tindakan")
     unknown_intent_count = (df['keyword_intent'] == 'Unknown').sum()
     st.sidebar.write(f"**{unknown_intent_count}** keyword belum memiliki intent (dari keseluruhan data).")
 
-    if st.sidebar.button(f" Generate & Save Intent", disabled=(unknown_intent_count == 0)):
-        df_unknown = df[df['keyword_intent'] == 'Unknown']
-        keywords_to_process = df_unknown[keyword_col].unique().tolist()
-        if not keywords_to_process:
+    use_batch_api = st.sidebar.checkbox("Gunakan Gemini Batch API (asinkron, hemat biaya)", value=False)
+    pending_batch_job = st.session_state.get('intent_batch_job')
+    if pending_batch_job:
+        st.sidebar.info(f"Job batch **{pending_batch_job}** masih berjalan. Klik tombol di bawah untuk melanjutkan.")
+
+    if st.sidebar.button(f" Generate & Save Intent", disabled=bool(unknown_intent_count == 0 and not pending_batch_job)):
+        # Kunci ternormalisasi sudah ada di state; dedup agar varian kapital/spasi tidak dikirim berulang ke Gemini.
+        # Sel keyword kosong (NA, atau string kosong setelah strip) tidak dikirim
+        keywords_to_process = [kw for kw in query_key[(df['keyword_intent'] == 'Unknown').to_numpy()].dropna().drop_duplicates().tolist() if kw]
+        if not keywords_to_process and not pending_batch_job:
             st.info("Semua keyword sudah memiliki intent.")
         else:
-            new_intents_dict = detect_all_intents_batched(keywords_to_process, delay=20)
-            if new_intents_dict:
-                with st.spinner("Menyimpan hasil AI langsung ke database..."):
-                    conn = get_db_conn()
-                    if conn:
-                        init_db(conn)
-                        df_to_save = pd.DataFrame(list(new_intents_dict.items()), columns=['Top queries', 'keyword_intent'])
-                        rows_saved = save_to_db(conn, df_to_save)
-                        if rows_saved > 0:
-                            st.success(f"{rows_saved} intent baru berhasil disimpan ke database!")
+            # Tabel dipastikan ada di thread utama; setiap potongan hasil AI lalu disimpan begitu batch-nya selesai
+            db_ready = False
+            with get_db_conn() as conn:
+                if conn:
+                    init_db(conn)
+                    db_ready = True
+            saved_counts, save_errors = [], []
+
+            def save_batch(intents):
+                # Bisa berjalan di thread executor: error dikumpulkan dan ditampilkan dari thread utama
+                try:
+                    saved_counts.append(save_intents(intents))
+                except Exception as e:
+                    save_errors.append(e)
+
+            new_intents_dict = detect_intents_with_cache(
+                keywords_to_process, use_batch_api,
+                on_batch=save_batch if db_ready else None
+            )
+            if save_errors:
+                st.error(f"{len(save_errors)} potongan hasil AI gagal disimpan ke database: {save_errors[0]}")
+            if new_intents_dict is None:
+                st.info("Job batch belum selesai. Klik tombol lagi nanti untuk melanjutkan.")
+            elif new_intents_dict:
+                rows_saved = sum(saved_counts)
+                if rows_saved > 0:
+                    st.success(f"{rows_saved} intent baru berhasil disimpan ke database!")
+                # Isi intent baru via lookup dict; baris tanpa hasil AI mempertahankan intent lamanya
                 df_state = st.session_state.df
-                df_new_intents = pd.DataFrame(list(new_intents_dict.items()), columns=['query_lower_case', 'new_intent'])
-                df_state['query_lower_case'] = df_state[keyword_col].str.lower()
-                df_merged = pd.merge(df_state, df_new_intents, on='query_lower_case', how='left')
-                df_merged['keyword_intent'] = df_merged['new_intent'].combine_first(df_merged['keyword_intent'])
-                df_merged.drop(columns=['query_lower_case', 'new_intent'], inplace=True)
-                st.session_state.df = df_merged
+                new_intents = query_key.map(new_intents_dict)
+                df_state['keyword_intent'] = as_intent_category(new_intents.fillna(df_state['keyword_intent'].astype(object)))
+                mark_df_changed()
                 st.info("Tampilan akan diperbarui...")
                 time.sleep(2)
                 st.rerun()
@@ -248,17 +802,19 @@ if uploaded_file is not None:
     st.sidebar.header("Filters")
     only_optimize = st.sidebar.checkbox("Hanya tampilkan yang 'Needs Optimization'", value=True)
     
-    display_df = df.copy()
+    # Semua filter digabung ke satu mask boolean, lalu df dipotong sekali saja
+    view_mask = np.ones(len(df), dtype=bool)
     if only_optimize:
-        display_df = display_df[display_df['Needs Optimization']]
+        view_mask &= df['Needs Optimization'].to_numpy(dtype=bool)
 
     st.subheader("Edit Intent Keyword")
     all_intents_list = sorted(df['keyword_intent'].unique().tolist())
     selected_intents = st.multiselect("Filter berdasarkan Intent:", options=all_intents_list, default=all_intents_list)
     if selected_intents:
-        display_df = display_df[display_df['keyword_intent'].isin(selected_intents)]
+        view_mask &= df['keyword_intent'].isin(selected_intents).to_numpy()
     else:
-        display_df = display_df.head(0)
+        view_mask[:] = False
+    display_df = df.iloc[view_mask]
     unknown_in_view = (display_df['keyword_intent'] == 'Unknown').sum()
     st.info(f"Anda dapat mengubah **Keyword Intent** di bawah. Tampilan saat ini memiliki **{unknown_in_view}** keyword tanpa intent.")
     
@@ -279,7 +835,7 @@ if uploaded_file is not None:
         column_config={
             get_original_header("keyword_intent"): st.column_config.SelectboxColumn(
                 "Keyword Intent",
-                options=["Informasional", "Komersial", "Navigasional", "Transaksional", "Unknown"],
+                options=INTENT_OPTIONS,
                 required=True
             ),
             get_original_header("Needs Optimization"): st.column_config.CheckboxColumn(
@@ -299,27 +855,35 @@ if uploaded_file is not None:
             if col in st.session_state.reverse_mapping
         })
         
-        comparison_df = df.merge(edited_df_standard, on=keyword_col, how="inner", suffixes=('_original', '_edited'))
-        changed_rows = comparison_df[comparison_df['keyword_intent_original'] != comparison_df['keyword_intent_edited']]
-        if changed_rows.empty:
+        # Diff berbasis index: bandingkan intent hasil edit dengan intent asli per keyword, tanpa merge
+        orig = df.set_index(keyword_col)['keyword_intent']
+        orig = orig[~orig.index.duplicated()]
+        edit = edited_df_standard.set_index(keyword_col)['keyword_intent']
+        changed_mask = edit.astype(object).ne(orig.reindex(edit.index).astype(object))
+        if not changed_mask.any():
             st.warning("Tidak ada perubahan yang terdeteksi.")
         else:
-            df_changes = pd.DataFrame({'Top queries': changed_rows[keyword_col], 'keyword_intent': changed_rows['keyword_intent_edited']})
-            conn = get_db_conn()
-            if conn:
-                with st.spinner(f"Menyimpan {len(df_changes)} perubahan ke database..."):
-                    init_db(conn)
-                    rows_affected = save_to_db(conn, df_changes)
-                    st.session_state.df.set_index(keyword_col, inplace=True)
-                    st.session_state.df['keyword_intent'].update(df_changes.set_index('Top queries')['keyword_intent'])
-                    st.session_state.df.reset_index(inplace=True)
-                    st.success(f"{rows_affected} perubahan berhasil disimpan!")
-                    st.rerun()
+            df_changes = edit[changed_mask].rename_axis('Top queries').reset_index()
+            # Simpan dengan kunci ternormalisasi yang sama dengan hasil AI, agar satu keyword tidak punya dua baris di tabel
+            df_changes['Top queries'] = normalize_keywords(df_changes['Top queries'])
+            with get_db_conn() as conn:
+                if conn:
+                    with st.spinner(f"Menyimpan {len(df_changes)} perubahan ke database..."):
+                        init_db(conn)
+                        rows_affected = save_to_db(conn, df_changes)
+                        # Tulis langsung ke baris yang berubah, tanpa set_index/update/reset_index
+                        updates = dict(zip(df_changes['Top queries'], df_changes['keyword_intent']))
+                        df_state = st.session_state.df
+                        m = query_key.isin(updates.keys()).to_numpy()
+                        df_state.loc[m, 'keyword_intent'] = query_key[m].map(updates).to_numpy()
+                        mark_df_changed()
+                        st.success(f"{rows_affected} perubahan berhasil disimpan!")
+                        st.rerun()
 
     st.sidebar.markdown("---")
     st.sidebar.download_button(
         "Download Data Tampilan", 
-        display_df_renamed.to_csv(index=False).encode('utf-8'), 
+        to_csv_bytes(display_df_renamed, st.session_state.df_version, (only_optimize, tuple(selected_intents))), 
         "seo_analyzed_data.csv", 
         "text/csv"
     )
@@ -327,64 +891,16 @@ if uploaded_file is not None:
     st.markdown("---")
 
     ### BLOK VISUALISASI DENGAN HEADER ASLI ###
-    df_viz = display_df[display_df['keyword_intent'] != 'Unknown'].copy()
+    df_viz = display_df[display_df['keyword_intent'] != 'Unknown']
 
     if not df_viz.empty:
-        # Dapatkan header asli
-        def get_original_header(standard_name):
-            return st.session_state.reverse_mapping.get(standard_name, standard_name)
-        
-        # Buat label untuk visualisasi
-        original_labels = {
-            'last_impressions': get_original_header('Last 3 months Impressions'),
-            'prev_impressions': get_original_header('Previous 3 months Impressions'),
-            'last_clicks': get_original_header('Last 3 months Clicks'),
-            'prev_clicks': get_original_header('Previous 3 months Clicks'),
-            'intent': 'Tipe Intent'
-        }
-        
-        intent_agg = df_viz.groupby('keyword_intent')[[
+        # Satu groupby kecil per rerun; spesifikasi chart dengan header asli diambil dari cache
+        intent_agg = df_viz.groupby('keyword_intent', sort=False, observed=True)[[
             'Previous 3 months Impressions', 'Last 3 months Impressions',
             'Previous 3 months Clicks', 'Last 3 months Clicks'
-        ]].sum().reset_index()
-
-        # Fungsi untuk membuat grafik
-        def create_chart(data, last_col, prev_col, title):
-            df_chart = pd.DataFrame({
-                'Intent': data['keyword_intent'],
-                original_labels['last_'+last_col.lower()]: data[f'Last 3 months {last_col}'],
-                original_labels['prev_'+last_col.lower()]: data[f'Previous 3 months {last_col}']
-            }).melt(id_vars='Intent', var_name='Periode', value_name='Total')
-            
-            chart = alt.Chart(df_chart).mark_bar().encode(
-                x=alt.X('Intent:N', title=original_labels['intent'], sort='-y'),
-                y=alt.Y('Total:Q', title=''),
-                color=alt.Color('Periode:N', title='Periode',
-                               scale=alt.Scale(range=['#4E79A7', '#F28E2B'])),
-                xOffset='Periode:N'
-            ).properties(
-                title=title,
-                width=600
-            )
-            return chart
+        ]].sum()
+        st.vega_lite_chart(build_intent_chart_spec(intent_agg, st.session_state.reverse_mapping), use_container_width=True)
 
-        # Tampilkan grafik
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            st.write(f"**{original_labels['last_impressions']} vs {original_labels['prev_impressions']}**")
-            st.altair_chart(
-                create_chart(intent_agg, 'Impressions', 'Impressions', ''),
-                use_container_width=True
-            )
-        
-        with col2:
-            st.write(f"**{original_labels['last_clicks']} vs {original_labels['prev_clicks']}**")
-            st.altair_chart(
-                create_chart(intent_agg, 'Clicks', 'Clicks', ''),
-                use_container_width=True
-            )
-            
     else:
         st.info("Tidak ada data untuk ditampilkan dalam visualisasi berdasarkan filter Anda saat ini.")
 